@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 # In[]:
 # Import required libraries
-import numpy as np
+import time
 
 import plotly.graph_objs as go
 import dash
@@ -12,12 +12,37 @@ from dash.dependencies import Input, Output, State, Event
 import dash_daq as daq
 
 from dash_daq_drivers import keithley_instruments
-
-# Instance of a Keithley2400 connected with Prologix GPIB to USB controller
+from dash_daq_drivers.data_storage import SortedIVBuffer
+from dash_daq_drivers.instrument_worker import InstrumentWorker
+from dash_daq_drivers.measurement_log import MeasurementLog
+from dash_daq_drivers.sweep_archive import SweepArchive
+
+# path of a file in which every measured point is logged, None to only keep
+# them in memory, see measurement_log.open_measurement_log to read it back
+MEASUREMENT_LOG_PATH = None
+# value logged for each source type
+LOG_SOURCE_TYPES = {'V': 0, 'I': 1}
+# path of a file in which every completed sweep is archived, None to not
+# archive them, see sweep_archive.SweepArchive to read them back
+SWEEP_ARCHIVE_PATH = None
+# points of the graph with the same source value, 'keep' all of them or
+# 'average' them
+DUPLICATE_SETPOINTS = 'keep'
+
+# Instance of a Keithley2400 connected with Prologix GPIB to USB controller,
+# the graph has its own copy of the points so the driver only keeps the
+# recent ones
 iv_generator = keithley_instruments.KT2400(
-    mock_mode=False
+    mock_mode=False,
+    max_stored_points=10000
 )
 
+# The callbacks run on different threads, the worker makes sure they talk to
+# the instrument one at a time. A callback still waits for the answer of the
+# instrument, this version of Dash cannot skip the update of an output so the
+# result cannot be collected later by a dcc.Interval
+iv_worker = InstrumentWorker(iv_generator)
+
 
 def is_instrument_port(port_name):
     """test if a string can be a com of gpib port"""
@@ -32,7 +57,7 @@ def is_instrument_port(port_name):
 
 class UsefulVariables:
     """Class to store information useful to callbacks"""
-    def __init__(self):
+    def __init__(self, measurement_log_path=None, sweep_archive_path=None):
         self.n_clicks = 0
         self.n_clicks_clear_graph = 0
         self.n_refresh = 0
@@ -41,6 +66,55 @@ class UsefulVariables:
         self.mode = 'single'
         self.sourced_values = []
         self.measured_values = []
+        # points of the graph sorted by source value
+        self.sorted_iv = SortedIVBuffer(DUPLICATE_SETPOINTS)
+        self.measurement_log = None
+        if measurement_log_path is not None:
+            self.measurement_log = MeasurementLog(
+                measurement_log_path,
+                fields=('time', 'source_type', 'source', 'measure')
+            )
+        self.sweep_archive = None
+        if sweep_archive_path is not None:
+            self.sweep_archive = SweepArchive(sweep_archive_path)
+        # index of the first point of the current sweep and its start time
+        self.sweep_start_index = 0
+        self.sweep_started = None
+
+    def add_point(self, src_type, source_value, measured_value):
+        """store a measured point and log it if a log is provided"""
+        self.sourced_values.append(source_value)
+        self.measured_values.append(measured_value)
+        self.sorted_iv.insert(source_value, measured_value)
+        if self.measurement_log is not None:
+            self.measurement_log.append(
+                time.time(),
+                LOG_SOURCE_TYPES[src_type],
+                source_value,
+                measured_value
+            )
+
+    def start_sweep(self):
+        """the next points belong to a new sweep"""
+        self.sweep_start_index = len(self.sourced_values)
+        self.sweep_started = time.time()
+
+    def archive_sweep(self, src_type, compliance):
+        """archive the points of the current sweep if an archive is
+            provided
+        """
+        if self.sweep_archive is not None:
+            source_unit, measure_unit = get_source_units(src_type)
+            self.sweep_archive.add(
+                self.sourced_values[self.sweep_start_index:],
+                self.measured_values[self.sweep_start_index:],
+                src_type=src_type,
+                source_unit=source_unit,
+                measure_unit=measure_unit,
+                compliance=compliance,
+                started=self.sweep_started
+            )
+        self.start_sweep()
 
     def change_n_clicks(self, nclicks):
         self.n_clicks = nclicks
@@ -61,21 +135,17 @@ class UsefulVariables:
     def clear_graph(self):
         self.sourced_values = []
         self.measured_values = []
+        self.sorted_iv.clear()
+        self.sweep_start_index = 0
 
     def sorted_values(self):
-        """ Sort the data so the are ascending according to the source """
-        data_array = np.vstack(
-            [
-                local_vars.sourced_values,
-                local_vars.measured_values
-            ]
-        )
-        data_array = data_array[:, data_array[0, :].argsort()]
+        """ The data ascending according to the source, the sourced values
+        in the first row and the measured ones in the second
+        """
+        return self.sorted_iv.values()
 
-        return data_array
 
-
-local_vars = UsefulVariables()
+local_vars = UsefulVariables(MEASUREMENT_LOG_PATH, SWEEP_ARCHIVE_PATH)
 
 # font and background colors associated with each themes
 bkg_color = {'dark': '#2a3f5f', 'light': '#F3F6FA'}
@@ -688,9 +758,16 @@ def instrument_port_btn_update(pwr_status, text, placeholder):
 )
 def instrument_port_btn_click(text):
     """reconnect the instrument to the new com port"""
-    iv_generator.connect(text)
-    print(iv_generator.ask('*IDN?'))
-    return str(iv_generator.ask('*IDN?'))
+    iv_worker.call('connect', text)
+    answer = str(
+        iv_worker.call(
+            'ask',
+            '*IDN?',
+            cache_ttl=keithley_instruments.QUERY_CACHE_TTL
+        )
+    )
+    print(answer)
+    return answer
 
 
 def automatic_grey_out_callback(div_id, app):
@@ -1178,6 +1255,7 @@ def sweep_activation_toggle(
             else:
                 # Initiate a sweep
                 print('sweep not on, initiating')
+                local_vars.start_sweep()
                 return True
 
 
@@ -1281,7 +1359,9 @@ def set_source_display(
         State('measure-display', 'value'),
         State('source-choice', 'value'),
         State('mode-choice', 'value'),
-        State('sweep-status', 'value')
+        State('sweep-status', 'value'),
+        State('sweep-stop', 'value'),
+        State('sweep-step', 'value')
     ]
 )
 def update_measure_display(
@@ -1290,7 +1370,9 @@ def update_measure_display(
     meas_old_val,
     src_type,
     mode_val,
-    swp_on
+    swp_on,
+    swp_stop,
+    swp_step
 ):
     """"read the measured value from the instrument
     check if a measure should be made
@@ -1303,20 +1385,32 @@ def update_measure_display(
 
     if mode_val == 'single':
         if meas_triggered:
-            # Save the sourced value
-            local_vars.sourced_values.append(source_value)
             # Initiate a measurement
-            measured_value = iv_generator.source_and_measure(src_type, src_val)
-            # Save the measured value
-            local_vars.measured_values.append(measured_value)
+            measured_value = iv_worker.call(
+                'source_and_measure',
+                src_type,
+                src_val
+            )
+            # Save the sourced and measured values
+            local_vars.add_point(src_type, source_value, measured_value)
     else:
         if meas_triggered and swp_on:
-            # Save the sourced value
-            local_vars.sourced_values.append(source_value)
             # Initiate a measurement
-            measured_value = iv_generator.source_and_measure(src_type, src_val)
-            # Save the measured value
-            local_vars.measured_values.append(measured_value)
+            measured_value = iv_worker.call(
+                'source_and_measure',
+                src_type,
+                src_val
+            )
+            # Save the sourced and measured values
+            local_vars.add_point(src_type, source_value, measured_value)
+            # Archive the sweep after its last point, same condition as in
+            # sweep_activation_toggle
+            if source_value > float(swp_stop) - float(swp_step):
+                if src_type == 'V':
+                    compliance = iv_generator.current_compliance
+                else:
+                    compliance = iv_generator.voltage_compliance
+                local_vars.archive_sweep(src_type, compliance)
 
     return measured_value
 
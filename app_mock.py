@@ -1,7 +1,5 @@
 # In[]:
 # Import required libraries
-import numpy as np
-
 import plotly.graph_objs as go
 import dash
 import dash_html_components as html
@@ -11,6 +9,7 @@ from dash.dependencies import Input, Output, State, Event
 import dash_daq as daq
 
 from dash_daq_drivers import keithley_instruments
+from dash_daq_drivers.data_storage import SortedIVBuffer
 
 # Instance of a Keithley2400
 iv_generator = keithley_instruments.KT2400('COM3', mock_mode=True)
@@ -38,6 +37,14 @@ class UsefulVariables:
         self.mode = 'single'
         self.sourced_values = []
         self.measured_values = []
+        # points of the graph sorted by source value
+        self.sorted_iv = SortedIVBuffer()
+
+    def add_point(self, source_value, measured_value):
+        """store a measured point"""
+        self.sourced_values.append(source_value)
+        self.measured_values.append(measured_value)
+        self.sorted_iv.insert(source_value, measured_value)
 
     def change_n_clicks(self, nclicks):
         self.n_clicks = nclicks
@@ -58,18 +65,13 @@ class UsefulVariables:
     def clear_graph(self):
         self.sourced_values = []
         self.measured_values = []
+        self.sorted_iv.clear()
 
     def sorted_values(self):
-        """ Sort the data so the are ascending according to the source """
-        data_array = np.vstack(
-            [
-                local_vars.sourced_values,
-                local_vars.measured_values
-            ]
-        )
-        data_array = data_array[:, data_array[0, :].argsort()]
-
-        return data_array
+        """ The data ascending according to the source, the sourced values
+        in the first row and the measured ones in the second
+        """
+        return self.sorted_iv.values()
 
 
 local_vars = UsefulVariables()
@@ -1009,20 +1011,16 @@ def update_measure_display(
 
     if mode_val == 'single':
         if meas_triggered:
-            # Save the sourced value
-            local_vars.sourced_values.append(source_value)
             # Initiate a measurement
             measured_value = iv_generator.source_and_measure(src_type, src_val)
-            # Save the measured value
-            local_vars.measured_values.append(measured_value)
+            # Save the sourced and measured values
+            local_vars.add_point(source_value, measured_value)
     else:
         if meas_triggered and swp_on:
-            # Save the sourced value
-            local_vars.sourced_values.append(source_value)
             # Initiate a measurement
             measured_value = iv_generator.source_and_measure(src_type, src_val)
-            # Save the measured value
-            local_vars.measured_values.append(measured_value)
+            # Save the sourced and measured values
+            local_vars.add_point(source_value, measured_value)
 
     return measured_value
 
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio interface to the instrument drivers
+
+pyserial and pyvisa only offer blocking calls, so every transaction runs in an
+executor thread while the event loop keeps serving other coroutines. A lock
+per instrument makes sure its transactions don't interleave.
+"""
+import asyncio
+import functools
+
+from .keithley_instruments import KT2400, sweep_setpoints
+
+
+class AsyncInstrument(object):
+    """asyncio wrapper around an instance of generic_instruments.Instrument"""
+
+    def __init__(self, instrument, executor=None):
+
+        # the wrapped synchronous driver
+        self.instrument = instrument
+
+        # None uses the default executor of the event loop
+        self.executor = executor
+
+        # created within the event loop by _run()
+        self.lock = None
+
+    def __str__(self):
+        return str(self.instrument)
+
+    async def _run(self, func, *args, **kwargs):
+        """run a blocking method of the instrument in the executor"""
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            return await loop.run_in_executor(
+                self.executor,
+                functools.partial(func, *args, **kwargs)
+            )
+
+    async def connect(self, instr_port_name=None, **kwargs):
+        return await self._run(
+            self.instrument.connect,
+            instr_port_name,
+            **kwargs
+        )
+
+    async def disconnect(self):
+        return await self._run(self.instrument.disconnect)
+
+    async def measure(self, instr_param):
+        return await self._run(self.instrument.measure, instr_param)
+
+    async def read(self, num_bytes=None, raw=False):
+        return await self._run(self.instrument.read, num_bytes, raw)
+
+    async def write(self, msg):
+        return await self._run(self.instrument.write, msg)
+
+    async def ask(
+            self,
+            msg,
+            num_bytes=None,
+            raw=False,
+            cache_ttl=None,
+            delay=None
+    ):
+        return await self._run(
+            self.instrument.ask,
+            msg,
+            num_bytes,
+            raw,
+            cache_ttl,
+            delay
+        )
+
+    async def ask_many(self, queries, cache_ttl=None):
+        return await self._run(self.instrument.ask_many, queries, cache_ttl)
+
+
+class AsyncKT2400(AsyncInstrument):
+    """asyncio driver of the Keithley 2400 SourceMeter, the arguments are
+        the ones of keithley_instruments.KT2400
+    """
+
+    def __init__(self, instr_port_name='', executor=None, **kwargs):
+        super(AsyncKT2400, self).__init__(
+            KT2400(instr_port_name, **kwargs),
+            executor
+        )
+
+    async def source_and_measure(self, instr_param, src_val):
+        return await self._run(
+            self.instrument.source_and_measure,
+            instr_param,
+            src_val
+        )
+
+    async def sweep(self, start, stop, step, src_type='V'):
+        return await self._run(
+            self.instrument.sweep,
+            start,
+            stop,
+            step,
+            src_type
+        )
+
+    async def source_list(self, setpoints, src_type='V'):
+        return await self._run(
+            self.instrument.source_list,
+            setpoints,
+            src_type
+        )
+
+    async def iter_sweep(self, start, stop, step, src_type='V'):
+        """software sweep yielding the sourced and measured values of each
+            point, the instrument is available to other coroutines between
+            two points
+        """
+        if step == 0:
+            print("The sweep step cannot be 0")
+            return
+
+        for src_val in sweep_setpoints(start, stop, step):
+            measured = await self.source_and_measure(src_type, src_val)
+            yield src_val, measured
+
+
+def test_iter_sweep_with_status_queries():
+    """run a software sweep while another coroutine queries the instrument"""
+
+    kt = AsyncKT2400('GPIB0::11', prologix='COM3')
+
+    async def sweep():
+        async for src_val, measured in kt.iter_sweep(0, 2, 0.5, 'V'):
+            print(src_val, measured)
+
+    async def status():
+        print(await kt.ask('*IDN?'))
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(asyncio.gather(sweep(), status()))
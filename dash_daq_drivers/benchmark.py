@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the KT2400 driver against simulated instruments
+
+    python -m dash_daq_drivers.benchmark --points 200 --output bench.json
+
+Every acquisition scenario is run through the Prologix, serial and VISA
+paths, each one talking to a KT2400Simulator on a pseudo terminal. The
+points per second, the p50/p99 latency per point and the bytes exchanged per
+point are printed and saved in a JSON file so they can be compared between
+revisions. A path which cannot be set up (e.g. no VISA backend for serial
+resources) is reported as skipped, as is a scenario which fails, e.g. when
+the readings containing the XON/XOFF bytes are altered by flow control.
+"""
+import argparse
+import json
+import platform
+import time
+
+import numpy as np
+
+from .generic_instruments import INTF_SERIAL, INTF_VISA
+from .communication_utils import PrologixController
+from .keithley_instruments import KT2400, fake_iv_relation
+from .simulator import KT2400Simulator, PrologixSimulator, SerialSimulator
+
+# GPIB address of the simulated KT2400 behind the Prologix controller
+BENCHMARK_GPIB_ADDRESS = 11
+
+# step in V between the setpoints of the sweeps
+BENCHMARK_STEP = 0.01
+
+# the currents of fake_iv_relation are above the default compliance
+BENCHMARK_COMPLIANCE = 5.
+
+# bytes used by XON/XOFF flow control
+FLOW_CONTROL_BYTES = [0x11, 0x13]
+
+
+def single_point(kt, num_points):
+    """measure num_points times at the same setpoint, returns the latency of
+        each point
+    """
+    latencies = []
+    for i in range(num_points):
+        start = time.time()
+        kt.source_and_measure('V', 1.)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def software_sweep(kt, num_points):
+    """measure num_points setpoints one source_and_measure call at a time,
+        returns the latency of each point
+    """
+    latencies = []
+    for i in range(num_points):
+        start = time.time()
+        kt.source_and_measure('V', i * BENCHMARK_STEP)
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def hardware_sweep(kt, num_points):
+    """measure num_points setpoints with a single triggered sweep, every point
+        gets the average latency
+    """
+    start = time.time()
+    kt.sweep(0, (num_points - 1) * BENCHMARK_STEP, BENCHMARK_STEP)
+    return [(time.time() - start) / num_points] * num_points
+
+
+def flow_control_setpoints(num_points):
+    """num_points current setpoints in uA which voltage readings contain one
+        of the FLOW_CONTROL_BYTES in the SREAL format, the setpoints have few
+        enough digits to be sent without rounding
+    """
+    candidates = np.arange(16000) * 1e-4
+    voltages = fake_iv_relation('I', candidates).astype('>f4')
+    readings = voltages.view(np.uint8).reshape(-1, 4)
+    flow_control = np.any(
+        (readings[:, :, np.newaxis] == FLOW_CONTROL_BYTES).any(axis=2),
+        axis=1
+    )
+    return np.resize(candidates[flow_control], num_points)
+
+
+def flow_control_list(kt, num_points):
+    """measure num_points setpoints which readings contain the
+        FLOW_CONTROL_BYTES with a list sweep, the readings are checked so a
+        transfer altered by flow control fails instead of being timed, every
+        point gets the average latency
+    """
+    setpoints = flow_control_setpoints(num_points)
+    start = time.time()
+    sourced, measured = kt.source_list(setpoints, 'I')
+    duration = time.time() - start
+
+    if len(measured) != num_points or not np.allclose(
+            measured,
+            fake_iv_relation('I', setpoints),
+            rtol=1e-5
+    ):
+        raise IOError("The readings were altered during the transfer")
+    return [duration / num_points] * num_points
+
+
+# scenarios run on every path, with the data format of the readings
+SCENARIOS = [
+    ('single_point', single_point, 'ASCII'),
+    ('software_sweep', software_sweep, 'ASCII'),
+    ('hardware_sweep', hardware_sweep, 'ASCII'),
+    ('hardware_sweep', hardware_sweep, 'SREAL'),
+    ('flow_control', flow_control_list, 'SREAL')
+]
+
+
+def open_prologix(sim_kwargs):
+    """returns the simulator and the KT2400 talking to it via Prologix"""
+    simulator = PrologixSimulator(
+        {BENCHMARK_GPIB_ADDRESS: KT2400Simulator(
+            current_compliance=BENCHMARK_COMPLIANCE
+        )},
+        **sim_kwargs
+    )
+    simulator.start()
+    kt = KT2400(
+        'GPIB0::%i' % BENCHMARK_GPIB_ADDRESS,
+        prologix=PrologixController(simulator.port)
+    )
+    return simulator, kt
+
+
+def open_serial(sim_kwargs):
+    """returns the simulator and the KT2400 talking to it via serial"""
+    simulator = SerialSimulator(
+        KT2400Simulator(current_compliance=BENCHMARK_COMPLIANCE),
+        **sim_kwargs
+    )
+    simulator.start()
+    kt = KT2400(
+        simulator.port,
+        interface=INTF_SERIAL,
+        baud_rate=sim_kwargs.get('baud_rate') or 9600,
+        term_chars='\n',
+        timeout=5
+    )
+    return simulator, kt
+
+
+def open_visa(sim_kwargs):
+    """returns the simulator and the KT2400 talking to it via a VISA serial
+        resource
+    """
+    simulator = SerialSimulator(
+        KT2400Simulator(current_compliance=BENCHMARK_COMPLIANCE),
+        **sim_kwargs
+    )
+    simulator.start()
+    try:
+        kt = KT2400(
+            'ASRL%s::INSTR' % simulator.port,
+            interface=INTF_VISA,
+            read_termination='\n',
+            write_termination='\n'
+        )
+    except Exception:
+        simulator.stop()
+        raise
+    return simulator, kt
+
+
+PATHS = [
+    ('prologix', open_prologix),
+    ('serial', open_serial),
+    ('visa', open_visa)
+]
+
+
+def run_scenario(kt, simulator, scenario, data_format, num_points):
+    """run a scenario once to warm the caches up and once measured, returns
+        its statistics
+    """
+    kt.set_data_format(data_format)
+    scenario(kt, num_points)
+
+    simulator.reset_stats()
+    start = time.time()
+    latencies = scenario(kt, num_points)
+    duration = time.time() - start
+    stats = simulator.stats()
+
+    return {
+        'points': num_points,
+        'points_per_s': num_points / duration,
+        'latency_p50_ms': 1e3 * np.percentile(latencies, 50),
+        'latency_p99_ms': 1e3 * np.percentile(latencies, 99),
+        'bytes_per_point':
+            (stats['bytes_in'] + stats['bytes_out']) / float(num_points)
+    }
+
+
+def run_benchmark(num_points=100, baud_rate=None, latency=0, paths=None):
+    """run every scenario on every path, returns a list of results"""
+    sim_kwargs = {'baud_rate': baud_rate, 'latency': latency}
+    results = []
+
+    for path, open_path in PATHS:
+        if paths is not None and path not in paths:
+            continue
+
+        try:
+            simulator, kt = open_path(sim_kwargs)
+        except Exception as e:
+            results.append({'path': path, 'skipped': repr(e)})
+            continue
+
+        try:
+            for name, scenario, data_format in SCENARIOS:
+                result = {
+                    'path': path,
+                    'scenario': name,
+                    'data_format': data_format
+                }
+                try:
+                    result.update(run_scenario(
+                        kt,
+                        simulator,
+                        scenario,
+                        data_format,
+                        num_points
+                    ))
+                except Exception as e:
+                    result['skipped'] = repr(e)
+                results.append(result)
+        finally:
+            kt.disconnect()
+            simulator.stop()
+
+    return results
+
+
+def print_results(results):
+    print(
+        "%-9s %-15s %-6s %10s %9s %9s %9s"
+        % ('path', 'scenario', 'format', 'points/s', 'p50 ms', 'p99 ms',
+           'B/point')
+    )
+    for result in results:
+        if 'skipped' in result:
+            print(
+                "%-9s %-15s %-6s skipped: %s"
+                % (
+                    result['path'],
+                    result.get('scenario', ''),
+                    result.get('data_format', ''),
+                    result['skipped']
+                )
+            )
+        else:
+            print(
+                "%-9s %-15s %-6s %10.1f %9.3f %9.3f %9.1f"
+                % (
+                    result['path'],
+                    result['scenario'],
+                    result['data_format'],
+                    result['points_per_s'],
+                    result['latency_p50_ms'],
+                    result['latency_p99_ms'],
+                    result['bytes_per_point']
+                )
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the KT2400 driver against simulated instruments'
+    )
+    parser.add_argument('--points', type=int, default=100)
+    parser.add_argument(
+        '--baud-rate',
+        type=int,
+        default=None,
+        help='emulate the transfer time of the bytes at this baud rate'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='time in seconds the instrument takes to answer'
+    )
+    parser.add_argument(
+        '--paths',
+        nargs='+',
+        choices=[path for path, open_path in PATHS],
+        default=None
+    )
+    parser.add_argument('--output', default='benchmark_results.json')
+    options = parser.parse_args()
+
+    results = run_benchmark(
+        num_points=options.points,
+        baud_rate=options.baud_rate,
+        latency=options.latency,
+        paths=options.paths
+    )
+    print_results(results)
+
+    with open(options.output, 'w') as f:
+        json.dump(
+            {
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'options': vars(options),
+                'results': results
+            },
+            f,
+            indent=2
+        )
+    print("Results saved in %s" % options.output)
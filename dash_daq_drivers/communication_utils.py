@@ -7,8 +7,16 @@ COM port or Prologix controller
 """
 import logging
 
+import bisect
 import glob
+import os
+import re
 import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 try:
     import serial
@@ -33,12 +41,128 @@ INTF_NONE = 'None'
 
 PROLOGIX_COM_PORT = "COM3"
 
+# time in seconds allowed to probe all the serial ports
+PROBE_TIME_BUDGET = 2
+# maximum number of serial ports probed at the same time
+PROBE_MAX_WORKERS = 16
 
-def list_gpib_ports():
-    """ use pyvisa to list the GPIB ports """
+# legacy BSD style pseudo terminals, e.g. /dev/ttyp0
+BSD_PTY_PATTERN = re.compile(r'tty[p-za-e][0-9a-f]$')
 
-    rm = visa.ResourceManager()
-    available_ports = rm.list_resources()
+# time in seconds during which the result of a device discovery is reused
+DISCOVERY_TTL = 30
+
+# timeouts in seconds used to probe the GPIB addresses, the timeout starts at
+# SCAN_INITIAL_TIMEOUT and then follows SCAN_TIMEOUT_FACTOR times the slowest
+# answer, within SCAN_MIN_TIMEOUT and SCAN_MAX_TIMEOUT
+SCAN_INITIAL_TIMEOUT = 0.05
+SCAN_MIN_TIMEOUT = 0.01
+SCAN_MAX_TIMEOUT = 0.1
+SCAN_TIMEOUT_FACTOR = 4
+
+# default GPIB read timeout of the Prologix controller in ms
+PROLOGIX_READ_TIMEOUT_MS = 500
+
+# message available bit of the status byte of an instrument
+STB_MAV = 0x10
+
+# time in seconds between the serial polls waiting for an answer
+MAV_POLL_INTERVAL = 0.05
+
+# initial size in bytes of the receive buffer of the Prologix controller
+RX_BUFFER_SIZE = 4096
+
+# upper bounds in seconds of the buckets of the latency histograms, the last
+# bucket counts the latencies above the last bound
+LATENCY_BUCKETS = [
+    1e-4, 2e-4, 5e-4, 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1, 2,
+    5
+]
+
+
+class DiscoveryCache(object):
+    """results of the device discoveries indexed per kind of discovery
+        once a result is older than ttl it is still returned right away
+        while a background thread scans the devices again
+    """
+
+    def __init__(self, ttl=DISCOVERY_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (time of the scan, result of the scan) indexed per key
+        self.entries = {}
+        # keys being scanned by a background thread
+        self.revalidating = set()
+
+    def get(self, key, scan, refresh=False):
+        """returns the cached result of scan(), the scan is run right away
+            if there is no result yet or if refresh is True
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None or refresh:
+            return list(self._scan(key, scan))
+
+        scan_time, result = entry
+        if time.time() - scan_time > self.ttl:
+            self._revalidate(key, scan)
+        return list(result)
+
+    def invalidate(self, key=None):
+        """forget the result of one kind of discovery or all of them"""
+        with self.lock:
+            if key is None:
+                self.entries = {}
+            else:
+                self.entries.pop(key, None)
+
+    def _scan(self, key, scan):
+        result = scan()
+        with self.lock:
+            self.entries[key] = (time.time(), result)
+        return result
+
+    def _revalidate(self, key, scan):
+        """scan the devices again in a background thread"""
+        with self.lock:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+
+        def revalidate():
+            try:
+                self._scan(key, scan)
+            except Exception:
+                logging.exception("The discovery of '%s' failed" % key)
+            finally:
+                with self.lock:
+                    self.revalidating.discard(key)
+
+        thread = threading.Thread(target=revalidate)
+        thread.daemon = True
+        thread.start()
+
+
+# shared by the discovery functions of this module
+discovery_cache = DiscoveryCache()
+
+# created on first use, building one is slow
+resource_manager = None
+
+
+def get_resource_manager():
+    """ returns the pyvisa resource manager shared by the module """
+    global resource_manager
+    if resource_manager is None:
+        resource_manager = visa.ResourceManager()
+    return resource_manager
+
+
+def scan_gpib_ports():
+    """ use pyvisa to scan the GPIB ports """
+
+    available_ports = get_resource_manager().list_resources()
     temp_ports = []
     for port in available_ports:
         if "GPIB" in port:
@@ -48,10 +172,51 @@ def list_gpib_ports():
     return available_ports
 
 
-def list_serial_ports(max_port_num=20):
+def list_gpib_ports(refresh=False):
+    """ use pyvisa to list the GPIB ports, the result of the last scan is
+    reused for DISCOVERY_TTL seconds unless refresh is True
+    """
+    return discovery_cache.get('gpib', scan_gpib_ports, refresh)
+
+
+def is_pseudo_terminal(port):
+    """ test if a serial port name belongs to a pseudo terminal or a virtual
+    console, which can never be connected to an instrument
+    """
+    name = os.path.basename(port)
+
+    if BSD_PTY_PATTERN.match(name):
+        return True
+
+    # on linux the terminals backed by a device have a device link in sysfs
+    sysfs_path = os.path.join('/sys/class/tty', name)
+    if os.path.isdir(sysfs_path):
+        return not os.path.exists(os.path.join(sysfs_path, 'device'))
+
+    return False
+
+
+def probe_serial_port(port):
+    """ returns the port name if it can be opened, None otherwise """
+    try:
+        s = serial.Serial(port, 9600, timeout=0.1)
+        s.close()
+        return str(port)
+    except (OSError):
+        return None
+
+
+def list_serial_ports(
+    max_port_num=20,
+    time_budget=PROBE_TIME_BUDGET,
+    max_workers=PROBE_MAX_WORKERS
+):
     """ Lists serial port names from COM1 to COM20 in windows platform and
     lists all serial ports on linux platform
 
+    The ports are probed concurrently, the ones which are still being probed
+    after time_budget seconds are left out
+
         :raises EnvironmentError:
             On unsupported or unknown platforms
         :returns:
@@ -67,19 +232,35 @@ def list_serial_ports(max_port_num=20):
     else:
         raise EnvironmentError('Unsupported platform')
 
+    ports = [port for port in ports if not is_pseudo_terminal(port)]
+
+    if not ports:
+        return []
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(ports)))
+    probes = [executor.submit(probe_serial_port, port) for port in ports]
+    done, not_done = wait(probes, timeout=time_budget)
+    # don't wait for the ports which hang
+    executor.shutdown(wait=False)
+
+    if not_done:
+        logging.warning(
+            "%i serial port(s) could not be probed within %s s"
+            % (len(not_done), time_budget)
+        )
+
+    # keep the order of the ports
     result = []
-    for port in ports:
-        try:
-            s = serial.Serial(port, 9600, timeout=0.1)
-            result.append(str(port))
-            s.close()
-        except (OSError):
-            pass
+    for probe in probes:
+        if probe in done and probe.result() is not None:
+            result.append(probe.result())
     return result
 
 
-def refresh_device_port_list(debug=False):
-    """ Load VISA resource list for use in combo boxes """
+def refresh_device_port_list(debug=False, refresh=False):
+    """ Load VISA resource list for use in combo boxes, the result of the
+    last scan is reused for DISCOVERY_TTL seconds unless refresh is True
+    """
 
     if debug:
 
@@ -87,15 +268,16 @@ def refresh_device_port_list(debug=False):
 
     else:
 
-        return list_gpib_ports() + list_serial_ports()
+        return list_gpib_ports(refresh) \
+            + discovery_cache.get('serial', list_serial_ports, refresh)
 
 
-def find_prologix_ports():
+def find_prologix_ports(refresh=False):
     """
         go through the serial ports and wee which one returns the prologix
         version command
     """
-    serial_ports = list_serial_ports()
+    serial_ports = discovery_cache.get('serial', list_serial_ports, refresh)
     result = []
     for port in serial_ports:
         try:
@@ -134,6 +316,144 @@ def test_prologix_controller_creation_with_no_arg_conflict():
     print(pc2)
 
 
+def io_prefix(msg):
+    """key of a command in the I/O statistics, the first two nodes of the
+        header of each SCPI command or the Prologix command, e.g.
+        ':SOUR:VOLT:LEV 1;:READ?' -> ':SOUR:VOLT;:READ?'
+    """
+    msg = msg.strip()
+    if msg.startswith('++'):
+        return msg.split(' ')[0]
+    prefixes = []
+    for cmd in msg.split(';'):
+        header = cmd.strip().split(' ')[0]
+        prefix = ':'.join(header.split(':')[:3 if header[:1] == ':' else 2])
+        if header.endswith('?') and not prefix.endswith('?'):
+            prefix += '?'
+        prefixes.append(prefix)
+    return ';'.join(prefixes)
+
+
+class IOStats(object):
+    """counters of the exchanges with an instrument or a controller and
+        histograms of the latency of the queries indexed per io_prefix
+        the drivers only record them when their io_stats attribute isn't None
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = 0
+            self.bytes_out = 0
+            self.bytes_in = 0
+            self.timeouts = 0
+            self.retries = 0
+            # [count, total time, max time, histogram] indexed per prefix
+            self.latencies = {}
+
+    def record_write(self, msg, num_bytes):
+        """a command of num_bytes was sent"""
+        with self.lock:
+            self.commands += 1
+            self.bytes_out += num_bytes
+
+    def record_answer(self, msg, latency, num_bytes, timeout=False):
+        """the answer to msg of num_bytes came latency seconds after it was
+            sent, or was incomplete if timeout is True
+        """
+        prefix = io_prefix(msg)
+        with self.lock:
+            self.bytes_in += num_bytes
+            if timeout:
+                self.timeouts += 1
+            if prefix not in self.latencies:
+                self.latencies[prefix] = [
+                    0, 0., 0., [0] * (len(self.buckets) + 1)
+                ]
+            stats = self.latencies[prefix]
+            stats[0] += 1
+            stats[1] += latency
+            stats[2] = max(stats[2], latency)
+            stats[3][bisect.bisect_left(self.buckets, latency)] += 1
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def snapshot(self):
+        """returns the statistics as a dict"""
+        with self.lock:
+            latencies = {}
+            for prefix, stats in self.latencies.items():
+                count, total, max_latency, histogram = stats
+                latencies[prefix] = {
+                    'count': count,
+                    'mean': total / count,
+                    'max': max_latency,
+                    'histogram': list(histogram)
+                }
+            return {
+                'commands': self.commands,
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'timeouts': self.timeouts,
+                'retries': self.retries,
+                'buckets': list(self.buckets),
+                'latencies': latencies
+            }
+
+
+class PrologixTransaction(object):
+    """exchange with an instrument while holding the lock of the controller,
+        created by PrologixController.transaction()
+        queries switch the controller to auto-read mode and commands without
+        answer switch it back to manual mode
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+
+    def write(self, cmd):
+        """write a command which doesn't have an answer"""
+        self.controller.set_auto(0)
+        self.controller.write(cmd)
+
+    def read(self, num_bit, raw=False):
+        return self.controller.read(num_bit, raw=raw)
+
+    def readline(self):
+        return self.controller.readline()
+
+    def query(self, cmd, num_bit=None, raw=False, delay=None):
+        """write a command and read the answer, in auto-read mode the
+            controller doesn't need a ++read eoi
+            if the instrument can take delay seconds to answer, longer than
+            the read timeout of the controller, the status byte is polled
+            until the answer is available and it is read in manual mode
+        """
+        read_timeout_ms = self.controller.read_timeout_ms
+        if read_timeout_ms is None:
+            read_timeout_ms = PROLOGIX_READ_TIMEOUT_MS
+
+        if delay is not None and delay * 1000 >= read_timeout_ms:
+            self.controller.set_auto(0)
+            self.controller.write(cmd)
+            self.controller.wait_message(
+                delay + (self.controller.timeout() or 0)
+            )
+        else:
+            self.controller.set_auto(1)
+            self.controller.write(cmd)
+        if num_bit is not None:
+            return self.controller.read(num_bit, raw=raw)
+        else:
+            return self.controller.readline()
+
+
 class PrologixController(object):
     connection = None
 
@@ -149,6 +469,44 @@ class PrologixController(object):
 
         self.mock = mock
 
+        # the serial port the controller is connected to
+        self.com_port = com_port
+
+        # GPIB address currently selected on the controller
+        self.gpib_address = None
+
+        # the received bytes not consumed yet are rx_buffer[rx_start:rx_end]
+        self.rx_buffer = bytearray(RX_BUFFER_SIZE)
+        self.rx_start = 0
+        self.rx_end = 0
+
+        # held by the transactions with the instruments, reentrant so the
+        # methods of the controller can take it as well
+        self.lock = threading.RLock()
+        # statistics of the time in seconds spent waiting for the lock
+        self.lock_waits = 0
+        self.lock_wait_time = 0
+        self.lock_wait_max = 0
+
+        # GPIB read timeout of the controller in ms, None if unknown
+        self.read_timeout_ms = None
+
+        # result of the last complete scan_gpib_bus(), the highest address
+        # it covered and when it was done
+        self.gpib_scan = None
+        self.gpib_scan_ports = 0
+        self.gpib_scan_time = 0
+
+        # IOStats recording the exchanges on the bus, None when disabled
+        self.io_stats = None
+        # last command sent to an instrument and when, the answers are
+        # accounted to it
+        self.io_last_command = ''
+        self.io_last_time = 0
+
+        # the port is a USB virtual COM port which doesn't need flow
+        # control, XON/XOFF would drop the 0x11 and 0x13 bytes of binary
+        # readings
         if not self.mock:
             if com_port is None:
                 # the user didn't provide a COM port, so we look for one
@@ -160,6 +518,7 @@ class PrologixController(object):
                          controller, we are connecting to %s" % (com_port[0]))
 
                     com_port = com_port[0]
+                    self.com_port = com_port
                     print(
                         "... found a Prologix controller on the port '%s'" %
                         com_port
@@ -168,7 +527,6 @@ class PrologixController(object):
                     self.connection = serial.Serial(
                         com_port,
                         baud_rate,
-                        xonxoff=True,
                         stopbits=serial.STOPBITS_TWO,
                         timeout=timeout
                     )
@@ -181,7 +539,6 @@ class PrologixController(object):
                     self.connection = serial.Serial(
                         com_port,
                         baud_rate,
-                        xonxoff=True,
                         stopbits=serial.STOPBITS_TWO,
                         timeout=timeout
                     )
@@ -205,7 +562,7 @@ class PrologixController(object):
                 # important not to use the self.readline() method
                 # at this stage if auto == 0, otherwise the connector is going
                 # to prompt the instrument for a reading an generate an error
-                version_number = (self.connection.readline()).decode()
+                version_number = self._receive_line().tobytes().decode()
 
                 if "Prologix GPIB-USB Controller" not in version_number:
                     self.connection = None
@@ -224,14 +581,70 @@ class PrologixController(object):
 
     def __str__(self):
         if self.connection is not None:
-            self.write("++ver")
-            return (self.connection.readline()).decode()
+            with self.lock:
+                self.write("++ver")
+                return self._receive_line().tobytes().decode()
         else:
             return ""
 
     def controller_id(self):
         return self.__str__()
 
+    def close(self):
+        """close the serial port"""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    @contextmanager
+    def transaction(self, address=None):
+        """hold the controller for a sequence of exchanges with the
+            instrument at the GPIB address, other threads wait for the end of
+            the transaction before talking on the bus
+            yields a PrologixTransaction
+        """
+        start = time.time()
+        self.lock.acquire()
+        try:
+            wait_time = time.time() - start
+            self.lock_waits += 1
+            self.lock_wait_time += wait_time
+            self.lock_wait_max = max(self.lock_wait_max, wait_time)
+
+            if address is not None:
+                self.select_address(address)
+            yield PrologixTransaction(self)
+        finally:
+            self.lock.release()
+
+    def lock_stats(self):
+        """time spent waiting for the bus, shows the contention between
+            threads
+        """
+        if self.lock_waits:
+            mean_wait = self.lock_wait_time / self.lock_waits
+        else:
+            mean_wait = 0
+        return {
+            'transactions': self.lock_waits,
+            'total_wait': self.lock_wait_time,
+            'max_wait': self.lock_wait_max,
+            'mean_wait': mean_wait
+        }
+
+    def enable_io_stats(self, io_stats=None):
+        """record the exchanges on the bus in io_stats, or a new IOStats,
+            which is returned
+        """
+        if io_stats is None:
+            io_stats = IOStats()
+        self.io_stats = io_stats
+        return io_stats
+
+    def disable_io_stats(self):
+        self.io_stats = None
+
     def write(self, cmd):
         """use serial.write"""
         # add a new line if the command didn't have one already
@@ -240,28 +653,198 @@ class PrologixController(object):
         if self.connection is not None:
             #  print("Prologix in : ", cmd)
             self.connection.write(cmd.encode())
+            if self.io_stats is not None:
+                self.io_stats.record_write(cmd, len(cmd))
+                # the answers are accounted to the command, not to the
+                # commands switching the controller around it
+                if not cmd.startswith(
+                    ('++read', '++auto', '++addr', '++spoll')
+                ):
+                    self.io_last_command = cmd
+                    self.io_last_time = time.time()
+
+    def _record_answer(self, answer, timeout):
+        self.io_stats.record_answer(
+            self.io_last_command,
+            time.time() - self.io_last_time,
+            len(answer),
+            timeout
+        )
+
+    def select_address(self, address):
+        """select the GPIB address of the instrument to talk to, the
+            ++addr command is only sent if the address changes
+        """
+        address = str(address)
+        # another thread could be in a transaction with another address
+        with self.lock:
+            if address != self.gpib_address:
+                self.write('++addr %s' % address)
+                self.gpib_address = address
+
+    def set_auto(self, auto):
+        """switch the controller between auto-read (1) and manual (0) mode,
+            the ++auto command is only sent if the mode changes
+        """
+        auto = int(auto)
+        with self.lock:
+            if auto != self.auto:
+                self.write('++auto %i' % auto)
+                self.auto = auto
+
+    def set_read_timeout(self, timeout_ms):
+        """set the GPIB read timeout of the controller, the ++read_tmo_ms
+            command is only sent if the timeout changes
+        """
+        timeout_ms = max(1, int(timeout_ms))
+        with self.lock:
+            if timeout_ms != self.read_timeout_ms:
+                self.write('++read_tmo_ms %i' % timeout_ms)
+                self.read_timeout_ms = timeout_ms
+
+    def wait_message(self, timeout):
+        """serial poll the selected instrument until its status byte shows a
+            message available, returns False if it doesn't within timeout
+            seconds
+        """
+        deadline = time.time() + timeout
+        with self.lock:
+            while True:
+                # drop any late answer to a previous poll
+                self.reset_input_buffer()
+                self.write('++spoll')
+                status = self._receive_line().tobytes().strip()
+                if status.isdigit() and int(status) & STB_MAV:
+                    return True
+                if time.time() >= deadline:
+                    return False
+                time.sleep(MAV_POLL_INTERVAL)
+
+    def read(self, num_bit, raw=False):
+        """read num_bit bytes, the answer is not decoded if raw is True"""
+        answer = self.read_view(num_bit).tobytes()
+        # print("Prologix out (read) : ", answer)
+        if raw:
+            return answer
+        return (answer).decode()
 
-    def read(self, num_bit):
-        """use serial.read"""
+    def readline(self):
+        """read up to the next line feed"""
+        answer = self.readline_view().tobytes()
+        # print("Prologix out (readline): ", answer)
+        return answer.decode()
+
+    def read_view(self, num_bit):
+        """read num_bit bytes, returns a memoryview on the receive buffer
+            which is only valid until the next read
+        """
         if self.connection is not None:
-            if not self.auto:
-                self.write('++read eoi')
-            answer = self.connection.read(num_bit)
-            # print("Prologix out (read) : ", answer)
-            return (answer).decode()
+            with self.lock:
+                if not self.auto:
+                    self.write('++read eoi')
+                return self._receive(num_bit)
         else:
-            return ""
+            return memoryview(b"")
 
-    def readline(self):
-        """use serial.readline"""
+    def readline_view(self):
+        """read up to the next line feed, returns a memoryview on the
+            receive buffer which is only valid until the next read
+        """
         if self.connection is not None:
-            if not self.auto:
-                self.write('++read eoi')
-            answer = self.connection.readline()
-            # print("Prologix out (readline): ", answer)
-            return answer.decode()
+            with self.lock:
+                if not self.auto:
+                    self.write('++read eoi')
+                return self._receive_line()
         else:
-            return ""
+            return memoryview(b"")
+
+    def reset_input_buffer(self):
+        """drop the bytes received and not read yet"""
+        with self.lock:
+            self.rx_start = 0
+            self.rx_end = 0
+            if self.connection is not None:
+                self.connection.reset_input_buffer()
+
+    def _fill_rx_buffer(self):
+        """move all the bytes waiting on the serial port to the receive
+            buffer with a single read, waits up to the timeout for at least
+            one byte, returns the number of bytes received
+        """
+        num_bytes = max(1, self.connection.in_waiting)
+
+        if self.rx_end + num_bytes > len(self.rx_buffer):
+            unread = self.rx_buffer[self.rx_start:self.rx_end]
+            if len(unread) + num_bytes > len(self.rx_buffer):
+                # a new buffer leaves the views handed out untouched
+                self.rx_buffer = bytearray(
+                    max(2 * len(self.rx_buffer), len(unread) + num_bytes)
+                )
+            self.rx_buffer[:len(unread)] = unread
+            self.rx_start = 0
+            self.rx_end = len(unread)
+
+        view = memoryview(self.rx_buffer)
+        received = self.connection.readinto(
+            view[self.rx_end:self.rx_end + num_bytes]
+        )
+        view.release()
+
+        self.rx_end += received
+        return received
+
+    def _consume(self, num_bytes):
+        """hand out the next num_bytes of the receive buffer"""
+        answer = memoryview(self.rx_buffer)[
+            self.rx_start:self.rx_start + num_bytes
+        ]
+        self.rx_start += num_bytes
+        if self.rx_start == self.rx_end:
+            # the whole buffer is available again
+            self.rx_start = 0
+            self.rx_end = 0
+        return answer
+
+    def _receive(self, num_bytes):
+        """returns the next num_bytes received, less if the timeout is
+            reached first
+        """
+        timeout = False
+        while self.rx_end - self.rx_start < num_bytes:
+            if not self._fill_rx_buffer():
+                num_bytes = self.rx_end - self.rx_start
+                timeout = True
+        answer = self._consume(num_bytes)
+        if self.io_stats is not None:
+            self._record_answer(answer, timeout)
+        return answer
+
+    def _receive_line(self, terminator=b'\n'):
+        """returns the bytes received up to the terminator included, the
+            bytes received so far if the timeout is reached first
+        """
+        scanned = 0
+        while True:
+            index = self.rx_buffer.find(
+                terminator,
+                self.rx_start + scanned,
+                self.rx_end
+            )
+            if index >= 0:
+                answer = self._consume(
+                    index + len(terminator) - self.rx_start
+                )
+                if self.io_stats is not None:
+                    self._record_answer(answer, False)
+                return answer
+
+            # the terminator could start in the last bytes scanned
+            scanned = max(0, self.rx_end - self.rx_start - len(terminator) + 1)
+            if not self._fill_rx_buffer():
+                answer = self._consume(self.rx_end - self.rx_start)
+                if self.io_stats is not None:
+                    self._record_answer(answer, True)
+                return answer
 
     def timeout(self, new_timeout=None):
         """
@@ -276,31 +859,152 @@ class PrologixController(object):
                 self.connection.timeout = new_timeout
                 return old_timeout
 
-    def get_open_gpib_ports(self, num_ports=30):
+    def get_open_gpib_ports(self, num_ports=30, refresh=False):
         """Finds out which GPIB ports are available for prologix controller"""
-        open_ports = []
+        return list(self.scan_gpib_bus(num_ports, refresh=refresh).keys())
+
+    def scan_gpib_bus(self, num_ports=30, expected=None, refresh=False):
+        """Finds out which instruments are connected to the GPIB bus and
+            returns their *IDN? answer indexed per port ('GPIB0::n')
+
+            The presence is probed with a serial poll, which is cheaper than
+            a *IDN?, using a timeout adapted to the measured answer times.
+            The scan stops as soon as all the expected ports are found.
+            The result of a complete scan is kept by the controller and
+            reused for DISCOVERY_TTL seconds by the scans of the addresses it
+            covers, unless refresh is True.
+        """
+        with self.lock:
+            return self._scan_gpib_bus(num_ports, expected, refresh)
+
+    def _scan_gpib_bus(self, num_ports, expected, refresh):
+        if self.mock or self.connection is None:
+            return OrderedDict()
+
+        if self.gpib_scan is not None and not refresh \
+                and num_ports <= self.gpib_scan_ports \
+                and time.time() - self.gpib_scan_time <= DISCOVERY_TTL:
+            return OrderedDict(
+                (port, idn) for port, idn in self.gpib_scan.items()
+                if int(port.replace('GPIB0::', '')) <= num_ports
+            )
+
+        if expected is not None:
+            expected = set(
+                port if isinstance(port, str) else "GPIB0::%s" % port
+                for port in expected
+            )
+
+        old_timeout = self.timeout()
+        scan_timeout = SCAN_INITIAL_TIMEOUT
+        slowest_answer = 0
+        present = []
+        complete = True
+
+        for i in range(num_ports + 1):
+            answer, answer_time = self._serial_poll(i, scan_timeout)
+
+            if answer is None and scan_timeout < SCAN_MAX_TIMEOUT:
+                # the answer was incomplete, give it the longest timeout
+                if self.io_stats is not None:
+                    self.io_stats.record_retry()
+                answer, answer_time = self._serial_poll(i, SCAN_MAX_TIMEOUT)
+
+            if answer:
+                present.append(i)
+                # adapt the timeout to the slowest instrument
+                slowest_answer = max(slowest_answer, answer_time)
+                scan_timeout = min(
+                    SCAN_MAX_TIMEOUT,
+                    max(SCAN_MIN_TIMEOUT, SCAN_TIMEOUT_FACTOR * slowest_answer)
+                )
 
-        if not self.mock:
+            if expected is not None and expected.issubset(
+                "GPIB0::%s" % port for port in present
+            ):
+                complete = i == num_ports
+                break
 
-            # sets the timeout to quite fast
-            old_timeout = self.timeout(0.1)
-            # iterate the ports number
-            for i in range(num_ports + 1):
+        self.set_read_timeout(PROLOGIX_READ_TIMEOUT_MS)
+        self.timeout(old_timeout)
 
-                # change the GPIB address on the prologix controller
-                # prove if an instrument is connected to the port
-                self.write('++addr %i\n*IDN?\n' % i)
+        # only the instruments which are present are identified
+        open_ports = OrderedDict()
+        for i in present:
+            with self.transaction(i) as t:
+                open_ports["GPIB0::%s" % i] = t.query('*IDN?').strip()
 
-                # probe the answer
-                s = self.readline()
+        if complete:
+            self.gpib_scan = OrderedDict(open_ports)
+            self.gpib_scan_ports = num_ports
+            self.gpib_scan_time = time.time()
 
-                # if it is longer than zero it is an instrument
-                # we store the GPIB address
-                if len(s) > 0:
-                    open_ports.append("GPIB0::%s" % (i))
+        return open_ports
 
-            # resets the timeout to its original value
-            self.timeout(old_timeout)
-        #        print "Time out is", self.timeout()
+    def _serial_poll(self, address, timeout):
+        """serial poll an address, returns the status byte (an empty string
+            if the address doesn't answer, None if the answer is incomplete)
+            and the time it took to get it
+        """
+        if self.timeout() != timeout:
+            self.timeout(timeout)
+        self.set_read_timeout(timeout * 1000)
+        # drop any late answer to a previous poll
+        self.reset_input_buffer()
+        start = time.time()
+        self.write('++spoll %i' % address)
+        answer = self._receive_line().tobytes()
+        answer_time = time.time() - start
+
+        if answer and not answer.endswith(b'\n'):
+            return None, answer_time
+        return answer.decode().strip(), answer_time
+
+
+# controllers shared by the instruments, indexed per serial port
+prologix_controllers = {}
+# number of instruments using each controller, indexed per serial port
+prologix_references = {}
+prologix_lock = threading.Lock()
+
+
+def get_prologix_controller(com_port=None, **kwargs):
+    """ returns the controller connected to com_port, which is created if no
+    instrument uses it yet, without com_port a controller already in use is
+    returned before searching for one
+    each call should be balanced by a call to release_prologix_controller
+    """
+    with prologix_lock:
+        if com_port is None and prologix_controllers:
+            com_port = sorted(prologix_controllers.keys())[0]
 
-        return open_ports
+        if com_port not in prologix_controllers:
+            if com_port is None:
+                print('Searching for Prologix Controller...')
+            controller = PrologixController(com_port, **kwargs)
+            if controller.connection is None:
+                # nothing to share
+                return controller
+            com_port = controller.com_port
+            prologix_controllers[com_port] = controller
+            prologix_references[com_port] = 0
+
+        prologix_references[com_port] += 1
+        return prologix_controllers[com_port]
+
+
+def release_prologix_controller(controller):
+    """ the serial port of the controller is closed once the last instrument
+    using it releases it, controllers which weren't obtained from
+    get_prologix_controller are left untouched
+    """
+    with prologix_lock:
+        com_port = controller.com_port
+        if prologix_controllers.get(com_port) is not controller:
+            return
+
+        prologix_references[com_port] -= 1
+        if prologix_references[com_port] <= 0:
+            prologix_controllers.pop(com_port)
+            prologix_references.pop(com_port)
+            controller.close()
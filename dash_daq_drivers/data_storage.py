@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory storage of the measured values
+"""
+import numpy as np
+
+# number of values a channel buffer can hold before it first grows
+CHANNEL_INITIAL_SIZE = 256
+
+
+class ChannelBuffer(object):
+    """values of a measurement channel stored in a numpy array which doubles
+        its size when it is full
+
+        if max_points is provided only the last max_points values are kept,
+        the array then stops at twice that size and the kept values are
+        moved back to its beginning when it is full, so they are always
+        contiguous and last() never copies them
+
+        the views returned by last() are only valid until the next append
+    """
+
+    def __init__(
+            self,
+            max_points=None,
+            dtype=float,
+            initial_size=CHANNEL_INITIAL_SIZE
+    ):
+        self.max_points = max_points
+        self.dtype = dtype
+        self.initial_size = initial_size
+        self.clear()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        return self.last()[index]
+
+    def __iter__(self):
+        return iter(self.last())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.last(), dtype=dtype)
+
+    def __repr__(self):
+        return "ChannelBuffer(%s)" % np.array2string(self.last())
+
+    def clear(self):
+        """forget all the values"""
+        size = self.initial_size
+        if self.max_points is not None:
+            size = min(size, 2 * self.max_points)
+        self.data = np.empty(max(size, 1), dtype=self.dtype)
+        # the values are data[start:end]
+        self.start = 0
+        self.end = 0
+
+    def append(self, value):
+        self.extend([value])
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self.dtype).ravel()
+        num_values = len(values)
+
+        if self.max_points is not None and num_values >= self.max_points:
+            # the new values replace all the previous ones
+            values = values[-self.max_points:]
+            num_values = len(values)
+            self.start = 0
+            self.end = 0
+
+        if self.end + num_values > len(self.data):
+            self._make_room(num_values)
+
+        self.data[self.end:self.end + num_values] = values
+        self.end += num_values
+
+        if self.max_points is not None \
+                and self.end - self.start > self.max_points:
+            self.start = self.end - self.max_points
+
+    def _make_room(self, num_values):
+        """grow the array or move the values to its beginning so that
+            num_values can be added after them
+        """
+        size = self.end - self.start
+        capacity = len(self.data)
+        while capacity < size + num_values:
+            capacity *= 2
+        if self.max_points is not None:
+            capacity = max(min(capacity, 2 * self.max_points),
+                           size + num_values)
+
+        if capacity != len(self.data):
+            data = np.empty(capacity, dtype=self.dtype)
+            data[:size] = self.data[self.start:self.end]
+            self.data = data
+        else:
+            self.data[:size] = self.data[self.start:self.end]
+        self.start = 0
+        self.end = size
+
+    def last(self, num_points=None):
+        """returns a view on the last num_points values, all of them by
+            default
+        """
+        if num_points is None:
+            start = self.start
+        else:
+            start = max(self.start, self.end - num_points)
+        return self.data[start:self.end]
+
+
+# policies for the points with the same sourced value, either all of them are
+# kept or only one with the average of their measured values
+DUPLICATE_POLICIES = ['keep', 'average']
+
+
+class SortedIVBuffer(object):
+    """(sourced, measured) pairs kept sorted by sourced value in a
+        preallocated 2 x size array which doubles its size when it is full
+
+        a new pair is inserted at the position found by binary search and
+        the following pairs are shifted within the array, the points are
+        never sorted again and the array is only reallocated when it grows
+
+        the views returned by values() are only valid until the next insert
+    """
+
+    def __init__(self, duplicates='keep', initial_size=CHANNEL_INITIAL_SIZE):
+        if duplicates not in DUPLICATE_POLICIES:
+            raise ValueError(
+                "duplicates should be one of %s" % DUPLICATE_POLICIES
+            )
+        self.duplicates = duplicates
+        self.initial_size = initial_size
+        self.clear()
+
+    def __len__(self):
+        return self.size
+
+    def clear(self):
+        """forget all the points"""
+        # sourced values in the first row, measured ones in the second
+        self.data = np.empty((2, max(self.initial_size, 1)))
+        # number of points averaged in each column
+        self.counts = np.zeros(self.data.shape[1], dtype=int)
+        self.size = 0
+
+    def insert(self, sourced, measured):
+        """add a point, after the points with the same sourced value or
+            averaged with them
+        """
+        sources = self.data[0, :self.size]
+
+        if self.duplicates == 'average':
+            index = np.searchsorted(sources, sourced, side='left')
+            if index < self.size and sources[index] == sourced:
+                count = self.counts[index]
+                self.data[1, index] = (
+                    self.data[1, index] * count + measured
+                ) / (count + 1)
+                self.counts[index] = count + 1
+                return
+        else:
+            index = np.searchsorted(sources, sourced, side='right')
+
+        if self.size == self.data.shape[1]:
+            self._grow()
+
+        # shift the following points by one column
+        self.data[:, index + 1:self.size + 1] = self.data[:, index:self.size]
+        self.counts[index + 1:self.size + 1] = self.counts[index:self.size]
+
+        self.data[0, index] = sourced
+        self.data[1, index] = measured
+        self.counts[index] = 1
+        self.size += 1
+
+    def _grow(self):
+        data = np.empty((2, 2 * self.data.shape[1]))
+        data[:, :self.size] = self.data[:, :self.size]
+        counts = np.zeros(data.shape[1], dtype=int)
+        counts[:self.size] = self.counts[:self.size]
+        self.data = data
+        self.counts = counts
+
+    def values(self):
+        """returns a view on the 2 x n array of the sorted points, the
+            sourced values in the first row and the measured ones in the
+            second
+        """
+        return self.data[:, :self.size]
+
+    def sourced(self):
+        return self.data[0, :self.size]
+
+    def measured(self):
+        return self.data[1, :self.size]
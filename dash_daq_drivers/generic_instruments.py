@@ -5,10 +5,18 @@ Created on Tue Mar 27 18:12:03 2018
 @author: Pierre-Francois Duc
 """
 
+import time
+from contextlib import contextmanager
+
 import serial
 import visa
 
-from .communication_utils import PrologixController
+from .communication_utils import (
+    get_prologix_controller,
+    release_prologix_controller,
+    IOStats
+)
+from .data_storage import ChannelBuffer
 
 # names to manage the different interfaces used to connect to an instrument
 INTF_VISA = 'pyvisa'
@@ -16,6 +24,48 @@ INTF_PROLOGIX = 'prologix'
 INTF_SERIAL = 'serial'
 INTF_INTERNAL = 'internal'
 
+# commands which reset the whole configuration of an instrument
+RESET_COMMANDS = ['*RST', 'SYST:PRES']
+
+
+def scpi_subsystem(msg):
+    """returns the first two nodes of the header of a SCPI command in their
+        short form, e.g. ':SENSe:VOLTage:PROTection 21' -> ('SENS', 'VOLT')
+    """
+    header = msg.strip().split(' ')[0].lstrip(':').rstrip('?').upper()
+    return tuple(node[:4] for node in header.split(':')[:2])
+
+
+def scpi_bool(answer):
+    """converts the '0' or '1' answer to a boolean query"""
+    return bool(int(answer))
+
+
+class BatchedReply(object):
+    """answer to a query queued within Instrument.batch(), the value is
+        available once the batch has been sent
+    """
+
+    def __init__(
+            self,
+            msg,
+            num_bytes=None,
+            raw=False,
+            cache_ttl=None,
+            delay=None
+    ):
+        self.msg = msg
+        self.num_bytes = num_bytes
+        self.raw = raw
+        self.cache_ttl = cache_ttl
+        self.delay = delay
+        self.value = None
+        self.done = False
+
+    def set_value(self, value):
+        self.value = value
+        self.done = True
+
 
 class Instrument(object):
     """generic instrument class"""
@@ -28,6 +78,7 @@ class Instrument(object):
         mock_mode=False,
         instr_intf=None,
         instr_mesurands=None,
+        max_stored_points=None,
         **kwargs
     ):
 
@@ -50,7 +101,8 @@ class Instrument(object):
         self.params_units = instr_mesurands
         # value of the last measure indexed per measurement channel
         self.last_measure = {}
-        # array of all measures indexed per measurement channel
+        # measures indexed per measurement channel, only the last
+        # max_stored_points are kept if it is provided
         self.measured_data = {}
 
         # Instrument connexion attributes
@@ -63,12 +115,33 @@ class Instrument(object):
         self.instr_connexion = None
         # terminaison characters used to communicate with the instrument
         self.term_chars = ""
+        # whether the Prologix controller was obtained from
+        # get_prologix_controller and should be released by disconnect()
+        self.owns_controller = False
+        # port of the Prologix controller released by disconnect(), it is
+        # used again by connect()
+        self.prologix_com_port = None
+
+        # Instrument query cache attributes
+
+        # answers of the cacheable queries with their expiry time, indexed
+        # per query
+        self.query_cache = {}
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+
+        # commands queued within batch(), None when not batching
+        self.batch_queue = None
+
+        # IOStats recording the exchanges with the instrument, None when
+        # disabled
+        self.io_stats = None
 
         for param in instr_mesurands:
             # initializes the first measured value to 0 and the channels'
             # names
             self.measure_params.append(param)
-            self.measured_data[param] = []
+            self.measured_data[param] = ChannelBuffer(max_stored_points)
             self.last_measure[param] = 0
             self.params_names[param] = param
 
@@ -84,13 +157,14 @@ class Instrument(object):
 
                 # the connection is passed as an argument
                 if isinstance(kwargs[INTF_PROLOGIX], str):
-                    # if it was the COM PORT number we initiate an instance
-                    # of prologix controller
+                    # if it was the COM PORT number we use the prologix
+                    # controller shared by the instruments on that port
                     if "COM" in kwargs[INTF_PROLOGIX]:
-                        self.instr_connexion = PrologixController(
+                        self.instr_connexion = get_prologix_controller(
                             com_port=kwargs[INTF_PROLOGIX],
                             **kwargs
                         )
+                        self.owns_controller = True
                 else:
                     # it was the PrologixController instance
                     self.instr_connexion = kwargs[INTF_PROLOGIX]
@@ -105,9 +179,9 @@ class Instrument(object):
                         )
 
             else:
-                # the connection doesn't exist so we create it
-                print('Searching for Prologix Controller...')
-                self.instr_connexion = PrologixController(**kwargs)
+                # use a controller already open or search for one
+                self.instr_connexion = get_prologix_controller(**kwargs)
+                self.owns_controller = True
 
         if not self.mock_mode and instr_port_name is not '':
             self.connect(instr_port_name, **kwargs)
@@ -131,17 +205,37 @@ class Instrument(object):
         """
         pass
 
-    def read(self, num_bytes=None):
-        """reads data available on the port"""
+    def read(self, num_bytes=None, raw=False):
+        """reads data available on the port
+            if raw is True the bytes are returned without being decoded
+        """
 
         if not self.mock_mode:
             if self.instr_intf == INTF_VISA:
-                answer = self.instr_connexion.read()
-            elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
+                if num_bytes is not None:
+                    # binary data can contain the termination character
+                    answer = self.instr_connexion.read_bytes(
+                        num_bytes,
+                        break_on_termchar=False
+                    )
+                    if not raw:
+                        answer = answer.decode()
+                elif raw:
+                    answer = self.instr_connexion.read_raw()
+                else:
+                    answer = self.instr_connexion.read()
+            elif self.instr_intf == INTF_PROLOGIX:
+                if num_bytes is not None:
+                    answer = self.instr_connexion.read(num_bytes, raw=raw)
+                else:
+                    answer = self.instr_connexion.readline()
+            elif self.instr_intf == INTF_SERIAL:
                 if num_bytes is not None:
                     answer = self.instr_connexion.read(num_bytes)
                 else:
                     answer = self.instr_connexion.readline()
+                if not raw:
+                    answer = answer.decode()
             # the provided instrument interface is unknown
             else:
                 answer = None
@@ -151,44 +245,337 @@ class Instrument(object):
 
         return answer
 
+    def enable_io_stats(self, io_stats=None):
+        """record the commands and answers exchanged with the instrument in
+            io_stats, or a new IOStats, which is returned
+        """
+        if io_stats is None:
+            io_stats = IOStats()
+        self.io_stats = io_stats
+        return io_stats
+
+    def disable_io_stats(self):
+        self.io_stats = None
+
+    def invalidate(self):
+        """forget what the driver knows of the state of the instrument"""
+        self.clear_query_cache()
+
+    def clear_query_cache(self):
+        """forget all the cached answers"""
+        self.query_cache = {}
+
+    def query_cache_stats(self):
+        """returns the hit and miss counters of the query cache"""
+        return {
+            'hits': self.query_cache_hits,
+            'misses': self.query_cache_misses,
+            'size': len(self.query_cache)
+        }
+
+    def _invalidate_queries(self, msg):
+        """drop the cached answers of the queries related to the subsystems
+            a command writes to
+        """
+        for cmd in msg.split(';'):
+            header = cmd.strip().split(' ')[0]
+            if header == '' or header.endswith('?'):
+                continue
+            if header.lstrip(':').upper() in RESET_COMMANDS:
+                self.clear_query_cache()
+                return
+            subsystem = scpi_subsystem(cmd)
+            for query in list(self.query_cache.keys()):
+                query_subsystem = scpi_subsystem(query)
+                n = min(len(subsystem), len(query_subsystem))
+                if subsystem[:n] == query_subsystem[:n]:
+                    self.query_cache.pop(query)
+
+    @contextmanager
+    def batch(self):
+        """queue the commands written and asked within the context and send
+            them as a single compound command when leaving it
+            ask() returns BatchedReply objects which values are set once the
+            batch is sent, nested batches are merged into the outer one
+        """
+        if self.batch_queue is not None:
+            yield
+            return
+
+        self.batch_queue = []
+        try:
+            yield
+            queue = self.batch_queue
+            self.batch_queue = None
+            self._send_batch(queue)
+        except Exception:
+            # the state cached when the commands were queued doesn't match
+            # the instrument if they weren't all sent
+            self.batch_queue = None
+            self.invalidate()
+            raise
+
+    def _queue_reply(self, reply):
+        """add a query to the batch, only a batch with a single query can
+            get a raw answer as binary answers cannot be split
+        """
+        for cmd, queued_reply in self.batch_queue:
+            if queued_reply is not None \
+                    and (reply.raw or queued_reply.raw):
+                raise ValueError(
+                    "A raw query cannot be batched with other queries"
+                )
+        self.batch_queue.append((reply.msg, reply))
+
+    def _send_batch(self, queue):
+        """join the queued commands with ';' into a compound command, send
+            it and dispatch the answers to the queued replies
+        """
+        if not queue:
+            return
+
+        cmds = []
+        for cmd, reply in queue:
+            cmd = cmd.strip().rstrip(';')
+            # each command of a compound command starts from the root node
+            if not cmd.startswith((':', '*')):
+                cmd = ':' + cmd
+            cmds.append(cmd)
+        msg = ';'.join(cmds)
+
+        replies = [reply for cmd, reply in queue if reply is not None]
+
+        if not replies:
+            self.write(msg)
+            return
+
+        # the queries are executed one after the other
+        delays = [reply.delay for reply in replies if reply.delay is not None]
+        delay = sum(delays) if delays else None
+
+        if self.mock_mode:
+            answers = [reply.msg for reply in replies]
+        elif len(replies) == 1:
+            reply = replies[0]
+            answers = [
+                self.ask(
+                    msg,
+                    num_bytes=reply.num_bytes,
+                    raw=reply.raw,
+                    delay=delay
+                )
+            ]
+        else:
+            answers = self.ask(msg, delay=delay).strip().split(';')
+
+        if len(answers) != len(replies):
+            raise IOError(
+                "%s answered %i values to %i queries: %s"
+                % (self.instr_id_name, len(answers), len(replies), msg)
+            )
+
+        for reply, answer in zip(replies, answers):
+            reply.set_value(answer)
+            if reply.cache_ttl is not None:
+                self.query_cache[reply.msg] = (
+                    time.time() + reply.cache_ttl,
+                    answer
+                )
+
+    def ask_many(self, queries, cache_ttl=None):
+        """sends several queries as a single compound command and returns
+            their answers as a tuple
+            each query is either a string or a (string, type) pair, the type
+            being applied to the answer, e.g. (':SENS:VOLT:PROT:LEV?', float)
+        """
+        if self.batch_queue is not None:
+            raise ValueError("ask_many cannot be used within batch()")
+
+        replies = []
+        with self.batch():
+            for query in queries:
+                if isinstance(query, tuple):
+                    msg, convert = query
+                else:
+                    msg, convert = query, None
+                replies.append((self.ask(msg, cache_ttl=cache_ttl), convert))
+
+        answers = []
+        for reply, convert in replies:
+            answer = reply.value
+            if convert is not None and not self.mock_mode:
+                answer = convert(answer)
+            answers.append(answer)
+        return tuple(answers)
+
     def write(self, msg):
         """writes command to the instrument but does not require a response"""
 
+        if self.query_cache:
+            self._invalidate_queries(msg)
+
+        if self.batch_queue is not None:
+            self.batch_queue.append((msg, None))
+            return msg
+
         if not self.mock_mode:
-            if self.instr_intf == INTF_PROLOGIX:
-                # make sure the address is the right one
-                self.instr_connexion.write(
-                    "++addr %s" % self.instr_port_name)
-            if self.instr_connexion is not None:
+            if self.instr_intf == INTF_PROLOGIX \
+                    and self.instr_connexion is not None:
+                # make sure the address is the right one and the controller
+                # doesn't read an answer
+                with self.instr_connexion.transaction(
+                    self.instr_port_name
+                ) as transaction:
+                    answer = transaction.write(msg)
+            elif self.instr_intf == INTF_SERIAL \
+                    and self.instr_connexion is not None:
+                answer = self.instr_connexion.write(
+                    (msg + self.term_chars).encode()
+                )
+            elif self.instr_connexion is not None:
                 answer = self.instr_connexion.write(msg + self.term_chars)
             else:
                 raise(IOError("There is no physical connexion established \
 with the instrument %s" % self.instr_id_name))
+            if self.io_stats is not None:
+                self.io_stats.record_write(
+                    msg,
+                    len(msg) + len(self.term_chars)
+                )
         else:
             answer = msg
         return answer
 
-    def ask(self, msg, num_bytes=None):
-        """ writes a command to the instrument and reads its reply """
+    def ask(
+            self,
+            msg,
+            num_bytes=None,
+            raw=False,
+            cache_ttl=None,
+            delay=None
+    ):
+        """ writes a command to the instrument and reads its reply
+            if raw is True the reply is returned without being decoded
+            if cache_ttl is provided the reply is cached for that many seconds
+            and reused until a command is written to the same subsystem
+            if delay is provided the reply can take that many seconds more
+            than usual to come, e.g. after a long acquisition
+            within batch() a BatchedReply is returned instead of the reply
+        """
+
+        if cache_ttl is not None:
+            if msg in self.query_cache:
+                expiry, answer = self.query_cache[msg]
+                if time.time() < expiry:
+                    self.query_cache_hits += 1
+                    if self.batch_queue is not None:
+                        reply = BatchedReply(msg)
+                        reply.set_value(answer)
+                        return reply
+                    return answer
+            self.query_cache_misses += 1
+
+        if self.batch_queue is not None:
+            reply = BatchedReply(msg, num_bytes, raw, cache_ttl, delay)
+            self._queue_reply(reply)
+            return reply
 
         answer = None
 
         if not self.mock_mode:
+            if self.io_stats is not None:
+                start = time.time()
             if self.instr_intf == INTF_VISA:
-                answer = self.instr_connexion.ask(msg)
+                with self._extended_timeout(delay):
+                    if raw or num_bytes is not None:
+                        self.instr_connexion.write(msg)
+                        answer = self.read(num_bytes, raw=raw)
+                    else:
+                        answer = self.instr_connexion.ask(msg)
+            elif self.instr_intf == INTF_PROLOGIX \
+                    and self.instr_connexion is not None:
+                # no other thread can talk on the bus between the command
+                # and its answer, which the controller reads automatically
+                with self.instr_connexion.transaction(
+                    self.instr_port_name
+                ) as transaction:
+                    answer = transaction.query(
+                        msg,
+                        num_bytes,
+                        raw=raw,
+                        delay=delay
+                    )
             elif self.instr_intf in (INTF_SERIAL, INTF_PROLOGIX):
                 self.write(msg)
-                answer = self.read(num_bytes)
+                with self._extended_timeout(delay):
+                    answer = self.read(num_bytes, raw=raw)
+            if self.io_stats is not None:
+                self._record_answer(msg, answer, num_bytes, start)
         else:
             answer = msg
+
+        if cache_ttl is not None:
+            self.query_cache[msg] = (time.time() + cache_ttl, answer)
+
         return answer
 
+    @contextmanager
+    def _extended_timeout(self, delay):
+        """add delay seconds to the timeout of the serial or VISA connexion
+            within the context
+        """
+        timeout = getattr(self.instr_connexion, 'timeout', None)
+        if delay is None or timeout is None:
+            # no timeout to extend
+            yield
+            return
+
+        if self.instr_intf == INTF_VISA:
+            # pyvisa counts the timeout in ms
+            self.instr_connexion.timeout = timeout + 1000 * delay
+        else:
+            self.instr_connexion.timeout = timeout + delay
+        try:
+            yield
+        finally:
+            self.instr_connexion.timeout = timeout
+
+    def _record_answer(self, msg, answer, num_bytes, start):
+        """record a query in io_stats, its command was written by write()
+            unless the interface handles queries itself
+        """
+        if self.instr_intf == INTF_VISA or (
+            self.instr_intf == INTF_PROLOGIX
+            and self.instr_connexion is not None
+        ):
+            self.io_stats.record_write(msg, len(msg) + len(self.term_chars))
+
+        if answer is None:
+            answer = ''
+        if num_bytes is not None:
+            timeout = len(answer) < num_bytes
+        elif self.instr_intf == INTF_VISA:
+            # pyvisa strips the termination and raises on timeouts
+            timeout = False
+        else:
+            timeout = answer[-1:] not in ('\n', b'\n')
+
+        self.io_stats.record_answer(
+            msg,
+            time.time() - start,
+            len(answer),
+            timeout
+        )
+
     def connect(self, instr_port_name=None, **kwargs):
         """implements the connexion to the instrument"""
 
         if instr_port_name is None:
             instr_port_name = self.instr_port_name
 
+        # the answers could come from another instrument
+        self.clear_query_cache()
+
         if self.mock_mode:
             print(
                 "Connect %s, named %s on port %s, with %s"
@@ -233,8 +620,14 @@ with the instrument %s" % self.instr_id_name))
                 # only keeps the number of the port
                 self.instr_port_name = instr_port_name.replace('GPIB0::', '')
 
-                self.instr_connexion.write(
-                    ("++addr %s" % self.instr_port_name))
+                if self.instr_connexion is None:
+                    # the controller was released by disconnect()
+                    self.instr_connexion = get_prologix_controller(
+                        com_port=self.prologix_com_port
+                    )
+                    self.owns_controller = True
+
+                self.instr_connexion.select_address(self.instr_port_name)
 
                 # the \n termchar is embedded in the PrologixController class
                 self.term_chars = ""
@@ -251,6 +644,16 @@ with the instrument %s" % self.instr_id_name))
         """disconnect the instrument"""
 
         if self.instr_connexion is not None:
-            # should write exception handling as we experience it
-            # or do that specifically for the children classes
-            self.instr_connexion.close()
+            if self.instr_intf == INTF_PROLOGIX:
+                # the controller may be shared with other instruments, only
+                # the reference this instrument took is released, the one
+                # passed by the user is kept
+                if self.owns_controller:
+                    release_prologix_controller(self.instr_connexion)
+                    self.prologix_com_port = self.instr_connexion.com_port
+                    self.instr_connexion = None
+                    self.owns_controller = False
+            else:
+                # should write exception handling as we experience it
+                # or do that specifically for the children classes
+                self.instr_connexion.close()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Dedicated thread owning an instrument
+
+The methods of the instrument are queued and executed one at a time by the
+worker thread, so concurrent callers never interleave bytes on the bus. Each
+submission returns a concurrent.futures.Future, call() waits for it.
+
+The worker only serializes the access to the bus, a caller using call() is
+still blocked until the instrument answers, behind the commands queued
+before its own.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class InstrumentWorker(object):
+    """serialize the calls to the methods of an instrument through a queue"""
+
+    def __init__(self, instrument, name=None):
+
+        # the instrument is only used from the worker thread
+        self.instrument = instrument
+
+        # each item is a (future, method name, args, kwargs) tuple, None stops
+        # the worker
+        self.commands = queue.Queue()
+
+        if name is None:
+            name = "%s worker" % instrument
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        """execute the queued commands until stop() is called"""
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+
+            future, method_name, args, kwargs = command
+            if not future.set_running_or_notify_cancel():
+                # the caller cancelled the command while it was queued
+                continue
+
+            try:
+                result = getattr(self.instrument, method_name)(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, method_name, *args, **kwargs):
+        """queue a call to a method of the instrument and return a Future
+            holding its result
+        """
+        if not self.is_alive():
+            raise RuntimeError("The worker of %s is stopped" % self.instrument)
+
+        future = Future()
+        self.commands.put((future, method_name, args, kwargs))
+        return future
+
+    def call(self, method_name, *args, **kwargs):
+        """queue a call to a method of the instrument and wait for its
+            result, the calling thread is blocked meanwhile
+        """
+        return self.submit(method_name, *args, **kwargs).result()
+
+    def pending(self):
+        """number of commands waiting to be executed"""
+        return self.commands.qsize()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def stop(self, wait=True):
+        """stop the worker once the queued commands are executed"""
+        self.commands.put(None)
+        if wait:
+            self.thread.join()
@@ -7,7 +7,12 @@ labprotocol/Keithley2400Manual.pdf'
 """
 import numpy as np
 
-from .generic_instruments import Instrument, INTF_PROLOGIX
+from .generic_instruments import (
+    Instrument,
+    INTF_PROLOGIX,
+    INTF_SERIAL,
+    scpi_bool
+)
 
 
 def fake_iv_relation(
@@ -43,6 +48,18 @@ def fake_iv_relation(
         return answer
 
 
+def sweep_setpoints(start, stop, step):
+    """values sourced by a staircase sweep from start to stop, the sign of
+    step is ignored as the sweep always goes from start towards stop
+    the last value doesn't go beyond stop if the span isn't a multiple of
+    step
+    """
+    # the epsilon keeps stop when the division is off by a rounding error
+    num_points = int(np.floor(abs(float(stop - start) / step) + 1e-9)) + 1
+    step = np.sign(stop - start) * abs(step)
+    return float(start) + np.arange(num_points) * step
+
+
 INTERFACE = INTF_PROLOGIX
 
 SRC_TYPES = [
@@ -56,6 +73,61 @@ SRC_MODES = [
     'SWE'       # Sweep outputs
 ]
 
+# elements which can be returned for each reading, refer to :FORM:ELEM in the
+# KT2400 manual
+READING_ELEMENTS = [
+    'VOLT',     # Voltage
+    'CURR',     # Current
+    'RES',      # Resistance
+    'TIME',     # Timestamp
+    'STAT'      # Status word
+]
+
+# elements needed by each measured parameter
+MEASURE_ELEMENTS = {
+    'V': ['VOLT'],
+    'I': ['CURR']
+}
+
+# formats used to transfer the readings, refer to :FORM:DATA in the KT2400
+# manual, both binary formats are IEEE-754 single precision
+DATA_FORMATS = [
+    'ASCII',    # Comma separated values
+    'REAL,32',  # Binary
+    'SREAL'     # Binary
+]
+
+# byte orders of the binary formats, refer to :FORM:BORD in the KT2400 manual
+BYTE_ORDERS = {
+    'NORM': '>f4',  # Big-endian
+    'SWAP': '<f4'   # Little-endian
+}
+
+# the binary readings are preceded by this header and followed by a LF
+BINARY_HEADER = b'#0'
+
+# time in seconds during which the answers to the configuration queries are
+# reused, unless a command changes the corresponding setting
+QUERY_CACHE_TTL = 60
+
+# the trigger count of the KT2400 cannot exceed the size of its buffer
+MAX_TRIGGER_COUNT = 2500
+
+# a source list holds at most 100 setpoints
+MAX_LIST_POINTS = 100
+
+# number of setpoints sent per command when uploading a source list
+LIST_CHUNK_SIZE = 20
+
+# format of the numbers sent to the instrument, 9 significant digits keep
+# the setpoints as they were given
+SCPI_NUMBER_FORMAT = '%.9g'
+
+# upper bound of the time in seconds taken by a reading (integration, auto
+# zero and source delay), the answer to a :READ? only comes once all the
+# readings are acquired
+READING_TIME = 0.05
+
 
 class KT2400(Instrument):
     """"driver of the Keithley 2400 SourceMeter"""
@@ -83,6 +155,15 @@ class KT2400(Instrument):
         if interface == INTF_PROLOGIX:
             kwargs['auto'] = 0
 
+        # reading format and shadow configuration, defined before the parent
+        # class calls initialize() if a port is provided
+        self.data_format = 'ASCII'
+        self.byte_order = 'SWAP'
+        self.reading_elements = list(READING_ELEMENTS)
+        # shadow copy of the configuration of the instrument, indexed per
+        # SCPI header, used to skip the commands which wouldn't change it
+        self.config_state = {}
+
         super(KT2400, self).__init__(instr_port_name,
                                      instr_id_name='KT2400',
                                      instr_user_name=instr_user_name,
@@ -114,17 +195,119 @@ class KT2400(Instrument):
         """check if the argument is a valid source type"""
         return self._check_arg(arg, arg_list=SRC_TYPES)
 
+    def _check_is_data_format(self, arg):
+        """check if the argument is a valid data format"""
+        return self._check_arg(arg, arg_list=DATA_FORMATS)
+
+    def _check_is_reading_element(self, arg):
+        """check if the argument is a valid reading element"""
+        return self._check_arg(arg, arg_list=READING_ELEMENTS)
+
+    def _check_is_byte_order(self, arg):
+        """check if the argument is a valid byte order"""
+        return self._check_arg(arg, arg_list=list(BYTE_ORDERS.keys()))
+
     def _clear_register(self):
         """refer to p 15-4 of the KT2400 manual"""
         if not self.mock_mode:
             self.write(':STAT:PRES')
 
+    def _write_config(self, header, value, msg):
+        """send msg only if it changes the value associated with the header
+            in the shadow configuration, returns True if it was sent
+        """
+        if self.config_state.get(header) == value:
+            return False
+        self.write(msg)
+        self.config_state[header] = value
+        return True
+
+    def invalidate(self):
+        """forget the shadow configuration and the cached queries, to be
+            called whenever the instrument could have been configured behind
+            the driver's back
+        """
+        self.config_state = {}
+        self.clear_query_cache()
+
+    def reset(self):
+        """reset the instrument to its default configuration and send the
+            settings the driver relies on
+        """
+        if not self.mock_mode:
+            self.write('*RST')
+            self.initialize()
+
     def initialize(self):
         """get the compliance and the auto output parameters"""
         if self.instr_connexion is not None:
-            self.auto_output_off = self.enquire_auto_output_off()
-            self.voltage_compliance = self.get_voltage_compliance()
-            self.current_compliance = self.get_current_compliance()
+            self.invalidate()
+            (
+                self.auto_output_off,
+                self.voltage_compliance,
+                self.current_compliance
+            ) = self.ask_many(
+                [
+                    (':SOUR:CLE:AUTO?', scpi_bool),
+                    (':SENS:VOLT:PROT:LEV?', float),
+                    (':SENS:CURR:PROT:LEV?', float)
+                ],
+                cache_ttl=QUERY_CACHE_TTL
+            )
+
+    def set_data_format(self, data_format='ASCII', byte_order='SWAP'):
+        """select the format used to transfer the readings, it is sent
+            along with the next reading
+            refer to :FORM:DATA and :FORM:BORD in the KT2400 manual
+        """
+        if self._check_is_data_format(data_format) \
+                and self._check_is_byte_order(byte_order):
+            self.data_format = data_format
+            self.byte_order = byte_order
+
+    def _write_data_format(self):
+        """make sure the instrument uses the selected data format"""
+        if self.data_format != 'ASCII' and self.instr_intf == INTF_SERIAL \
+                and getattr(self.instr_connexion, 'xonxoff', False):
+            print(
+                "The XON/XOFF flow control of %s would drop bytes of the "
+                "binary readings, the readings are transferred in ASCII"
+                % self.instr_port_name
+            )
+            self.data_format = 'ASCII'
+        self._write_config(
+            'FORM:DATA',
+            self.data_format,
+            ':FORM:DATA %s' % self.data_format
+        )
+        if self.data_format != 'ASCII':
+            self._write_config(
+                'FORM:BORD',
+                self.byte_order,
+                ':FORM:BORD %s' % self.byte_order
+            )
+
+    def set_reading_elements(self, elements=None):
+        """select the elements returned for each reading
+            refer to :FORM:ELEM in the KT2400 manual
+        """
+        if elements is None:
+            elements = READING_ELEMENTS
+
+        for element in elements:
+            if not self._check_is_reading_element(element):
+                return
+
+        # the instrument always returns the elements in the same order
+        elements = [elem for elem in READING_ELEMENTS if elem in elements]
+
+        if not self.mock_mode:
+            self._write_config(
+                'FORM:ELEM',
+                tuple(elements),
+                ':FORM:ELEM %s' % ','.join(elements)
+            )
+        self.reading_elements = elements
 
     def connect(self, instr_port_name, **kwargs):
         super(KT2400, self).connect(instr_port_name, **kwargs)
@@ -133,39 +316,14 @@ class KT2400(Instrument):
     def measure(self, instr_param):
         if instr_param in self.measure_params:
 
-            if instr_param == 'V':
-                if not self.mock_mode:
-                    # Initiate a voltage measure (turn output ON)
-                    self.write('CONF:VOLT')
-                    answer = self.ask(':READ?')
-                    # Voltage comes in first position by default
-                    answer = float(answer.split(',')[0])
-                    # Check that the value is not larger than the compliance
-                    if answer >= self.voltage_compliance:
-                        print("Measured voltage is at compliance level")
-                else:
-                    answer = np.random.random()
-
-                self.last_measure[instr_param] = answer
-
-            elif instr_param == 'I':
-                if not self.mock_mode:
-                    # Initiate a current measure (turn output ON)
-                    self.write(':CONF:CURR')
-                    answer = self.ask(':READ?')
-                    # Voltage comes in second position by default
-                    answer = float(answer.split(',')[1])
-                    # Check that the value is not larger than the compliance
-                    if answer >= self.current_compliance:
-                        print("Measured current is above compliance level")
-                else:
-                    answer = np.random.random()
+            if not self.mock_mode:
+                # Initiate a measure (turn output ON)
+                answer = self._request_measure(instr_param)
+                answer = self._finish_measure(instr_param, answer)
+            else:
+                answer = np.random.random()
 
-                self.last_measure[instr_param] = answer
-
-            self.measured_data[instr_param].append(
-                self.last_measure[instr_param]
-            )
+            self._store_measures(instr_param, [answer])
 
         else:
             print(
@@ -176,24 +334,55 @@ class KT2400(Instrument):
             answer = None
         return answer
 
+    def _request_measure(self, instr_param):
+        """configure and trigger a single reading, returns the answer to the
+            :READ? (a BatchedReply within batch())
+        """
+        meas_type = MEASURE_ELEMENTS[instr_param][0]
+        self._configure_measure(meas_type)
+        self.set_reading_elements(MEASURE_ELEMENTS[instr_param])
+        self._set_trigger_count(1)
+        return self._ask_readings()
+
+    def _finish_measure(self, instr_param, answer):
+        """extract the measured value from the answer to the :READ?"""
+        meas_type = MEASURE_ELEMENTS[instr_param][0]
+        readings = self._convert_readings(answer)
+        answer = float(self._reading_column(readings, meas_type)[0])
+        # Check that the value is not larger than the compliance
+        if instr_param == 'V':
+            if answer >= self.voltage_compliance:
+                print("Measured voltage is at compliance level")
+        elif instr_param == 'I':
+            if answer >= self.current_compliance:
+                print("Measured current is above compliance level")
+        return answer
+
     def source_and_measure(self, instr_param, src_val):
         """"set the given source and measure the corresponding measurand
             source voltage => measure current
             source current => measure voltage
+            the level, the reading and the output are sent as one command
         """
         if not self.mock_mode:
-            if instr_param == 'V':
-                self.configure_voltage_source()
-                self.set_voltage(src_val)
-                answer = self.measure_current()
-                self.disable_output()
-            elif instr_param == 'I':
-                self.configure_current_source()
-                self.set_current(src_val)
-                answer = self.measure_voltage()
-                self.disable_output()
+            params = self._source_params(instr_param)
+            if params is not None:
+                scpi_type, meas_type, meas_param, scale = params
+                if instr_param == 'V':
+                    self.configure_voltage_source()
+                else:
+                    self.configure_current_source()
+                with self.batch():
+                    if instr_param == 'V':
+                        self.set_voltage(src_val)
+                    else:
+                        self.set_current(src_val)
+                    self.enable_output()
+                    reply = self._request_measure(meas_param)
+                    self.disable_output()
+                answer = self._finish_measure(meas_param, reply.value)
+                self._store_measures(meas_param, [answer])
             else:
-                print("The source type should be either 'I' or 'V'")
                 answer = np.nan
         else:
             answer = np.round(
@@ -202,13 +391,252 @@ class KT2400(Instrument):
             )
         return answer
 
+    def _source_params(self, src_type):
+        """SCPI names and scale factor associated with a source type
+            source voltage => measure current
+            source current (in uA) => measure voltage
+        """
+        if src_type == 'V':
+            return 'VOLT', 'CURR', 'I', 1
+        elif src_type == 'I':
+            return 'CURR', 'VOLT', 'V', 1e-6
+        else:
+            print("The source type should be either 'I' or 'V'")
+            return None
+
+    def _configure_measure(self, meas_type):
+        """select the measured function"""
+        if self._write_config('CONF', meas_type, ':CONF:%s' % meas_type):
+            # we don't rely on the trigger count kept by the instrument
+            self.config_state.pop('TRIG:COUN', None)
+            # :CONF turns the output on
+            self.config_state['OUTP'] = 'ON'
+
+    def _set_trigger_count(self, num_points):
+        """number of readings acquired by each :READ?"""
+        self._write_config(
+            'TRIG:COUN',
+            num_points,
+            ':TRIG:COUN %i' % num_points
+        )
+
+    def _triggered_read(self, meas_type, num_points):
+        """acquire num_points readings with a single :READ? and return the
+            values of the measured element
+        """
+        self.set_reading_elements([meas_type])
+        self._set_trigger_count(num_points)
+        readings = self._read_readings(num_points)
+        return self._reading_column(readings, meas_type)
+
+    def _store_measures(self, meas_param, measured):
+        """keep track of the values acquired in bulk"""
+        if len(measured):
+            self.last_measure[meas_param] = measured[-1]
+            self.measured_data[meas_param].extend(measured)
+
+    def sweep(self, start, stop, step, src_type='V'):
+        """source a staircase sweep and measure every point in a single
+            triggered acquisition, refer to the sweep operation section of the
+            KT2400 manual
+            source voltage => measure current
+            source current (in uA) => measure voltage
+            returns the arrays of sourced and measured values
+        """
+        params = self._source_params(src_type)
+        if params is None:
+            return np.array([]), np.array([])
+        scpi_type, meas_type, meas_param, scale = params
+
+        if step == 0:
+            print("The sweep step cannot be 0")
+            return np.array([]), np.array([])
+
+        sourced = sweep_setpoints(start, stop, step)
+        num_points = len(sourced)
+        if num_points > MAX_TRIGGER_COUNT:
+            print(
+                "A sweep cannot have more than %i points, %i were asked"
+                % (MAX_TRIGGER_COUNT, num_points)
+            )
+            return np.array([]), np.array([])
+
+        # the instrument expects the step to go from start towards stop
+        step = np.sign(stop - start) * abs(step)
+
+        if not self.mock_mode:
+            # select the measured function before the sweep parameters
+            self._configure_measure(meas_type)
+            self.configure_source(scpi_type, 'SWE')
+            for header, value in (
+                ('STAR', start * scale),
+                ('STOP', stop * scale),
+                ('STEP', step * scale)
+            ):
+                header = 'SOUR:%s:%s' % (scpi_type, header)
+                self._write_config(
+                    header,
+                    value,
+                    ':%s %s' % (header, SCPI_NUMBER_FORMAT % value)
+                )
+            measured = self._triggered_read(meas_type, num_points)
+            self.configure_source(scpi_type, 'FIX')
+            self.disable_output()
+        else:
+            measured = np.round(fake_iv_relation(src_type, sourced), 4)
+
+        self._store_measures(meas_param, measured)
+
+        return sourced, measured
+
+    def source_list(self, setpoints, src_type='V'):
+        """source arbitrary setpoints using the LIST source mode and measure
+            every point in triggered acquisitions of up to MAX_LIST_POINTS
+            source voltage => measure current
+            source current (in uA) => measure voltage
+            returns the arrays of sourced and measured values
+        """
+        params = self._source_params(src_type)
+        if params is None:
+            return np.array([]), np.array([])
+        scpi_type, meas_type, meas_param, scale = params
+
+        # Make sure the format is a numpy array
+        sourced = np.append(np.array([]), setpoints)
+
+        if not self.mock_mode:
+            self._configure_measure(meas_type)
+            measured = []
+            for i in range(0, len(sourced), MAX_LIST_POINTS):
+                self._upload_list(
+                    scpi_type,
+                    sourced[i:i + MAX_LIST_POINTS] * scale
+                )
+                self.configure_source(scpi_type, 'LIST')
+                measured.append(
+                    self._triggered_read(
+                        meas_type,
+                        len(sourced[i:i + MAX_LIST_POINTS])
+                    )
+                )
+            measured = np.concatenate(measured) if measured else np.array([])
+            self.configure_source(scpi_type, 'FIX')
+            self.disable_output()
+        else:
+            measured = np.round(fake_iv_relation(src_type, sourced), 4)
+
+        self._store_measures(meas_param, measured)
+
+        return sourced, measured
+
+    def _upload_list(self, scpi_type, values):
+        """write the source list in chunks of LIST_CHUNK_SIZE values, the
+            first chunk replaces the list and the next ones are appended
+        """
+        for i in range(0, len(values), LIST_CHUNK_SIZE):
+            if i == 0:
+                cmd = ':SOUR:LIST:%s' % scpi_type
+            else:
+                cmd = ':SOUR:LIST:%s:APP' % scpi_type
+            chunk = values[i:i + LIST_CHUNK_SIZE]
+            self.write('%s %s' % (
+                cmd,
+                ','.join(SCPI_NUMBER_FORMAT % val for val in chunk)
+            ))
+
+    def _read_readings(self, num_points=1):
+        """trigger a :READ? and return an array with one row per reading and
+            one column per reading element
+        """
+        answer = self._ask_readings(num_points)
+        return self._convert_readings(answer, num_points)
+
+    def _ask_readings(self, num_points=1):
+        """trigger a :READ? and return its answer"""
+        self._write_data_format()
+        # without auto output off the instrument refuses to take a reading
+        # while the output is off
+        self.enable_output()
+        delay = num_points * READING_TIME
+        if self.data_format == 'ASCII':
+            answer = self.ask(':READ?', delay=delay)
+        else:
+            num_values = num_points * len(self.reading_elements)
+            # header, 4 bytes per value and the LF terminator
+            num_bytes = len(BINARY_HEADER) + 4 * num_values + 1
+            answer = self.ask(
+                ':READ?',
+                num_bytes=num_bytes,
+                raw=True,
+                delay=delay
+            )
+
+        # with auto output off the output is turned off after the reading,
+        # otherwise it stays on
+        if self.auto_output_off:
+            self.config_state['OUTP'] = 'OFF'
+        else:
+            self.config_state['OUTP'] = 'ON'
+
+        return answer
+
+    def _convert_readings(self, answer, num_points=1):
+        """convert the answer to a :READ? into an array with one row per
+            reading and one column per reading element
+        """
+        if self.data_format == 'ASCII':
+            return self._parse_readings(answer)
+        else:
+            return self._decode_readings(
+                answer,
+                num_points * len(self.reading_elements)
+            )
+
+    def _parse_readings(self, answer):
+        """convert the ASCII answer of a :READ? into an array with one row
+            per reading and one column per reading element
+        """
+        readings = np.array(answer.strip().split(','), dtype=float)
+        return readings.reshape(-1, len(self.reading_elements))
+
+    def _decode_readings(self, answer, num_values):
+        """convert the binary answer of a :READ? into an array with one row
+            per reading and one column per reading element, the array is a
+            view on the received bytes
+        """
+        if not answer.startswith(BINARY_HEADER):
+            raise IOError(
+                "The binary answer of %s doesn't start with %s"
+                % (self.instr_id_name, BINARY_HEADER)
+            )
+        num_bytes = len(BINARY_HEADER) + 4 * num_values
+        if len(answer) < num_bytes:
+            raise IOError(
+                "The binary answer of %s is incomplete, %i bytes were "
+                "received out of %i"
+                % (self.instr_id_name, len(answer), num_bytes)
+            )
+        readings = np.frombuffer(
+            answer,
+            dtype=BYTE_ORDERS[self.byte_order],
+            count=num_values,
+            offset=len(BINARY_HEADER)
+        )
+        return readings.reshape(-1, len(self.reading_elements))
+
+    def _reading_column(self, readings, element):
+        """values of one element from the readings array"""
+        return readings[:, self.reading_elements.index(element)]
+
     def measure_voltage(self):
         return self.measure('V')
 
     def get_voltage_compliance(self):
         """voltage compliance in Volt"""
         if not self.mock_mode:
-            return float(self.ask(':SENS:VOLT:PROT:LEV?'))
+            return float(
+                self.ask(':SENS:VOLT:PROT:LEV?', cache_ttl=QUERY_CACHE_TTL)
+            )
         else:
             return 20
 
@@ -218,57 +646,80 @@ class KT2400(Instrument):
     def get_current_compliance(self):
         """current compliance in Ampere"""
         if not self.mock_mode:
-            return float(self.ask(':SENS:CURR:PROT:LEV?'))
+            return float(
+                self.ask(':SENS:CURR:PROT:LEV?', cache_ttl=QUERY_CACHE_TTL)
+            )
         else:
             return 1
 
     def configure_source(self, src_type='CURR', src_mode='FIX'):
-        """refer to p 18-73 of the KT2400 manual"""
+        """refer to p 18-73 of the KT2400 manual
+            returns True if the source function was changed
+        """
+        changed = False
         if not self.mock_mode:
             if self._check_is_src_type(src_type):
-                self.write(':SOUR:FUNC:MODE %s' % src_type)
+                changed = self._write_config(
+                    'SOUR:FUNC:MODE',
+                    src_type,
+                    ':SOUR:FUNC:MODE %s' % src_type
+                )
                 if self._check_is_src_mode(src_mode):
-                    self.write(':SOUR:%s:MODE %s' % (src_type, src_mode))
+                    self._write_config(
+                        'SOUR:%s:MODE' % src_type,
+                        src_mode,
+                        ':SOUR:%s:MODE %s' % (src_type, src_mode)
+                    )
+        return changed
 
     def configure_voltage_source(self, src_mode='FIX'):
         """set the source to output voltage"""
         if not self.mock_mode:
-            self.configure_source('VOLT', src_mode)
-            self.current_compliance = self.get_current_compliance()
+            if self.configure_source('VOLT', src_mode):
+                self.current_compliance = self.get_current_compliance()
 
     def configure_current_source(self, src_mode='FIX'):
         """set the source to output current"""
         if not self.mock_mode:
-            self.configure_source('CURR', src_mode)
-            self.voltage_compliance = self.get_voltage_compliance()
+            if self.configure_source('CURR', src_mode):
+                self.voltage_compliance = self.get_voltage_compliance()
 
     def set_voltage(self, volt_val):
         """set the voltage for the output, does not turn output on"""
         if not self.mock_mode:
-            self.write(':SOUR:VOLT %f' % volt_val)
+            self._write_config(
+                'SOUR:VOLT',
+                volt_val,
+                ':SOUR:VOLT %s' % (SCPI_NUMBER_FORMAT % volt_val)
+            )
 
     def set_current(self, curr_val):
         """set the current (in uA) for the output, does not turn output on"""
         if not self.mock_mode:
-            self.write(':SOUR:CURR %f' % (curr_val * 1e-6))
+            self._write_config(
+                'SOUR:CURR',
+                curr_val,
+                ':SOUR:CURR %s' % (SCPI_NUMBER_FORMAT % (curr_val * 1e-6))
+            )
 
     def enable_output(self):
         """turn the output of the KT2400 on"""
         if not self.mock_mode:
             if not self.auto_output_off:
-                print('ENABLING')
-                self.write(':OUTP ON;')
+                self._write_config('OUTP', 'ON', ':OUTP ON;')
 
     def disable_output(self):
         """shut the output of the KT2400 off"""
         if not self.mock_mode:
             if not self.auto_output_off:
-                self.write(':OUTP OFF;')
+                self._write_config('OUTP', 'OFF', ':OUTP OFF;')
 
     def enquire_auto_output_off(self):
         """refer to p. 13 -7 of the KT2400 manual"""
         if not self.mock_mode:
-            return bool(int(self.ask(':SOUR:CLE:AUTO?')))
+            return bool(
+                int(self.ask(':SOUR:CLE:AUTO?', cache_ttl=QUERY_CACHE_TTL))
+            )
         else:
             return False
 
@@ -276,7 +727,7 @@ class KT2400(Instrument):
         """refer to p. 13 -7 of the KT2400 manual"""
         if not self.mock_mode:
             self.write(':SOUR:CLE:AUTO ON')
-            self.auto_output_off = self.ask(':SOUR:CLE:AUTO?')
+            self.auto_output_off = self.enquire_auto_output_off()
         else:
             self.auto_output_off = True
 
@@ -284,7 +735,7 @@ class KT2400(Instrument):
         """refer to p. 13 -7 of the KT2400 manual"""
         if not self.mock_mode:
             self.write(':SOUR:CLE:AUTO OFF')
-            self.auto_output_off = self.ask(':SOUR:CLE:AUTO?')
+            self.auto_output_off = self.enquire_auto_output_off()
         else:
             self.auto_output_off = False
 
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only binary log of the measured points
+
+A log starts with a header of LOG_HEADER_SIZE bytes (magic string, format
+version, number of fields, creation time and the comma separated names of
+the fields) followed by one record of little-endian float64 per point.
+
+The points are handed to the operating system as soon as they are appended,
+so they survive a crash of the process, and are synced to the disk by
+batches. A record cut by a crash of the computer is dropped when the log is
+opened again.
+"""
+import os
+import struct
+import time
+
+import numpy as np
+
+LOG_MAGIC = b'DDAQLOG\x00'
+LOG_VERSION = 1
+LOG_HEADER_SIZE = 256
+# magic, version, number of fields and creation time, followed by the names
+LOG_HEADER_FORMAT = '<8sIId'
+
+# the points are synced to the disk once there are that many of them or
+# once the oldest of them is that old in seconds
+LOG_SYNC_POINTS = 1000
+LOG_SYNC_INTERVAL = 1.
+
+
+def log_dtype(fields):
+    """numpy dtype of the records of a log"""
+    return np.dtype([(str(field), '<f8') for field in fields])
+
+
+def read_log_header(path):
+    """returns the fields and the creation time of a log"""
+    with open(path, 'rb') as f:
+        header = f.read(LOG_HEADER_SIZE)
+
+    if len(header) < LOG_HEADER_SIZE \
+            or header[:len(LOG_MAGIC)] != LOG_MAGIC:
+        raise IOError("%s is not a measurement log" % path)
+
+    magic, version, num_fields, created = struct.unpack_from(
+        LOG_HEADER_FORMAT,
+        header
+    )
+    if version != LOG_VERSION:
+        raise IOError(
+            "%s has the version %i of the log format, not %i"
+            % (path, version, LOG_VERSION)
+        )
+
+    names = header[struct.calcsize(LOG_HEADER_FORMAT):].rstrip(b'\x00')
+    fields = tuple(names.decode().split(','))
+    if len(fields) != num_fields:
+        raise IOError("The header of %s is corrupted" % path)
+    return fields, created
+
+
+def open_measurement_log(path):
+    """map the records of a log in memory, returns a numpy structured array
+        with one column per field
+    """
+    fields, created = read_log_header(path)
+    dtype = log_dtype(fields)
+    num_records = (os.path.getsize(path) - LOG_HEADER_SIZE) // dtype.itemsize
+
+    if num_records == 0:
+        # an empty file cannot be mapped
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode='r',
+        offset=LOG_HEADER_SIZE,
+        shape=(num_records,)
+    )
+
+
+class MeasurementLog(object):
+    """writer appending points to a log, a log which already exists with the
+        same fields is continued
+    """
+
+    def __init__(
+            self,
+            path,
+            fields=('time', 'source', 'measure'),
+            sync_points=LOG_SYNC_POINTS,
+            sync_interval=LOG_SYNC_INTERVAL
+    ):
+        self.path = path
+        self.fields = tuple(fields)
+        self.dtype = log_dtype(self.fields)
+        self.sync_points = sync_points
+        self.sync_interval = sync_interval
+
+        # points appended since the last sync and when the first of them was
+        self.unsynced_points = 0
+        self.unsynced_since = None
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            fields, self.created = read_log_header(path)
+            if fields != self.fields:
+                raise IOError(
+                    "%s logs the fields %s, not %s"
+                    % (path, fields, self.fields)
+                )
+            self.file = open(path, 'r+b')
+            # drop the end of a record which wasn't completely written
+            size = os.path.getsize(path) - LOG_HEADER_SIZE
+            self.file.truncate(
+                LOG_HEADER_SIZE + size - size % self.dtype.itemsize
+            )
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.created = time.time()
+            self.file = open(path, 'wb')
+            self.file.write(self._header())
+            self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _header(self):
+        names = ','.join(self.fields).encode()
+        header = struct.pack(
+            LOG_HEADER_FORMAT,
+            LOG_MAGIC,
+            LOG_VERSION,
+            len(self.fields),
+            self.created
+        ) + names
+        if len(header) > LOG_HEADER_SIZE:
+            raise ValueError("The names of the fields are too long")
+        return header.ljust(LOG_HEADER_SIZE, b'\x00')
+
+    def append(self, *values):
+        """log a point, with one value per field"""
+        self.extend([values])
+
+    def extend(self, points):
+        """log several points at once, e.g. the readings of a hardware
+            sweep, points has one row per point and one column per field
+        """
+        points = np.asarray(points, dtype='<f8')
+        if points.ndim != 2 or points.shape[1] != len(self.fields):
+            raise ValueError(
+                "The points should have %i values: %s"
+                % (len(self.fields), ', '.join(self.fields))
+            )
+
+        self.file.write(points.tobytes())
+        # a crash of the process doesn't lose the points the operating
+        # system has
+        self.file.flush()
+
+        if self.unsynced_since is None:
+            self.unsynced_since = time.time()
+        self.unsynced_points += len(points)
+
+        if self.unsynced_points >= self.sync_points \
+                or time.time() - self.unsynced_since >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        """write the logged points to the disk"""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced_points = 0
+        self.unsynced_since = None
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
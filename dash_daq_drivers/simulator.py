@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated instruments answering on a pseudo terminal
+
+The simulators open a pseudo terminal and answer on its master side, so the
+real drivers (PrologixController, serial.Serial, pyvisa ASRL resources) can
+connect to the slave side as they would to a physical port and be tested or
+benchmarked without hardware.
+
+    with PrologixSimulator({11: KT2400Simulator()}) as sim:
+        controller = PrologixController(sim.port)
+        kt = KT2400('GPIB0::11', prologix=controller)
+
+The transfer time of each byte can be emulated with baud_rate and the time
+the instrument takes to answer with latency.
+
+Only available on POSIX platforms.
+"""
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+from .communication_utils import STB_MAV
+from .keithley_instruments import (
+    fake_iv_relation,
+    sweep_setpoints,
+    READING_ELEMENTS,
+    BYTE_ORDERS,
+    BINARY_HEADER,
+    MAX_LIST_POINTS,
+    MAX_TRIGGER_COUNT
+)
+
+# short forms of the SCPI nodes understood by the simulators, a node is
+# replaced by the short form it starts with
+SCPI_SHORT_NODES = sorted(
+    [
+        'AMPL', 'APP', 'ARM', 'AUTO', 'BORD', 'CLE', 'CONF', 'CONT', 'COUN',
+        'CURR', 'DATA', 'ELEM', 'ERR', 'FEED', 'FORM', 'FUNC', 'IMM', 'LEV',
+        'LIST', 'MODE', 'NEXT', 'OUTP', 'POIN', 'PRES', 'PROT', 'READ', 'SENS',
+        'SOUR', 'STAR', 'STAT', 'STEP', 'STOP', 'SYST', 'TRAC', 'TRIG', 'VOLT'
+    ],
+    key=len,
+    reverse=True
+)
+
+# nodes which can be omitted from a SCPI header
+SCPI_OPTIONAL_NODES = ['LEV', 'IMM', 'AMPL']
+
+# headers which are aliases of other headers once the optional nodes are
+# removed
+SCPI_ALIASES = {
+    'SOUR:FUNC:MODE': 'SOUR:FUNC',
+    'OUTP:STAT': 'OUTP',
+    'CONF:VOLT:DC': 'CONF:VOLT',
+    'CONF:CURR:DC': 'CONF:CURR',
+    'FORM:ELEM:SENS': 'FORM:ELEM'
+}
+
+# answer of the Prologix controller to ++ver
+PROLOGIX_VERSION = 'Prologix GPIB-USB Controller version 6.101'
+
+# bits sent per byte by the serial port (start, 8 data, 2 stop bits)
+BITS_PER_BYTE = 11
+
+
+def scpi_header(cmd):
+    """split a SCPI command into its canonical header, its arguments and
+        whether it is a query, e.g. ':SOURce:VOLTage:LEVel 1' ->
+        ('SOUR:VOLT', '1', False)
+    """
+    cmd = cmd.strip()
+    if ' ' in cmd:
+        header, args = cmd.split(' ', 1)
+    else:
+        header, args = cmd, ''
+
+    query = header.endswith('?')
+    nodes = []
+    for node in header.rstrip('?').lstrip(':').upper().split(':'):
+        for short in SCPI_SHORT_NODES:
+            if node.startswith(short):
+                node = short
+                break
+        if node and node not in SCPI_OPTIONAL_NODES:
+            nodes.append(node)
+
+    header = ':'.join(nodes)
+    return SCPI_ALIASES.get(header, header), args.strip(), query
+
+
+def scpi_on_off(arg):
+    """convert ON/OFF/1/0 SCPI arguments into a boolean"""
+    return arg.strip().upper() in ('ON', '1')
+
+
+class KT2400Simulator(object):
+    """SCPI state machine of a Keithley 2400 SourceMeter, the measured values
+        follow fake_iv_relation and are limited by the compliance levels
+    """
+
+    def __init__(
+            self,
+            serial_number='0000000',
+            voltage_compliance=21.,
+            current_compliance=105e-6
+    ):
+
+        self.idn = (
+            'KEITHLEY INSTRUMENTS INC.,MODEL 2400,%s,C30 (simulated)'
+            % serial_number
+        )
+
+        # handlers of the commands indexed per canonical header, each one is
+        # called with the arguments and whether it is a query
+        self.handlers = {
+            '*IDN': self._idn,
+            '*RST': self._rst,
+            '*CLS': self._cls,
+            'STAT:PRES': self._cls,
+            'SYST:ERR': self._syst_err,
+            'SOUR:FUNC': self._sour_func,
+            'SOUR:CLE:AUTO': self._sour_cle_auto,
+            'TRIG:COUN': self._trig_coun,
+            'FORM:ELEM': self._form_elem,
+            'FORM:DATA': self._form_data,
+            'FORM:BORD': self._form_bord,
+            'OUTP': self._outp,
+            'READ': self._read,
+            'TRAC:POIN': self._trac_poin,
+            'TRAC:POIN:ACT': self._trac_poin_act,
+            'TRAC:FEED:CONT': self._trac_feed_cont,
+            'TRAC:CLE': self._trac_cle,
+            'TRAC:DATA': self._trac_data
+        }
+        for src_type in ('VOLT', 'CURR'):
+            self.handlers.update({
+                'SOUR:%s' % src_type: self._sour_param(src_type, 'LEV'),
+                'SOUR:%s:MODE' % src_type: self._sour_param(src_type, 'MODE'),
+                'SOUR:%s:STAR' % src_type: self._sour_param(src_type, 'STAR'),
+                'SOUR:%s:STOP' % src_type: self._sour_param(src_type, 'STOP'),
+                'SOUR:%s:STEP' % src_type: self._sour_param(src_type, 'STEP'),
+                'SOUR:LIST:%s' % src_type: self._sour_list(src_type, False),
+                'SOUR:LIST:%s:APP' % src_type: self._sour_list(src_type, True),
+                'SENS:%s:PROT' % src_type: self._sens_prot(src_type),
+                'CONF:%s' % src_type: self._conf(src_type)
+            })
+
+        # compliance levels after a *RST, the currents of fake_iv_relation
+        # are above the default level of the instrument
+        self.default_compliance = {
+            'VOLT': voltage_compliance,
+            'CURR': current_compliance
+        }
+
+        self.reset()
+
+    def reset(self):
+        """state after a *RST"""
+        self.src_func = 'VOLT'
+        self.src_params = {
+            'VOLT': {'LEV': 0., 'MODE': 'FIX', 'STAR': 0., 'STOP': 0.,
+                     'STEP': 0.},
+            'CURR': {'LEV': 0., 'MODE': 'FIX', 'STAR': 0., 'STOP': 0.,
+                     'STEP': 0.}
+        }
+        self.src_lists = {'VOLT': [0.], 'CURR': [0.]}
+        self.compliance = dict(self.default_compliance)
+        self.sense_func = 'CURR'
+        self.auto_output_off = False
+        self.output = False
+        self.trigger_count = 1
+        self.elements = list(READING_ELEMENTS)
+        self.data_format = 'ASCII'
+        self.byte_order = 'NORM'
+        self.trace_points = 100
+        self.trace_feed = 'NEV'
+        self.trace = []
+        self.errors = []
+        self.start_time = time.time()
+
+    def handle(self, line):
+        """execute a line of SCPI commands separated by ';', returns the
+            answers to the queries or None if there is no query
+        """
+        answers = []
+        for cmd in line.split(';'):
+            if not cmd.strip():
+                continue
+            header, args, query = scpi_header(cmd)
+            handler = self.handlers.get(header)
+            if handler is None:
+                self.error(-113, 'Undefined header')
+                continue
+            try:
+                answer = handler(args, query)
+            except (ValueError, IndexError):
+                self.error(-224, 'Illegal parameter value')
+                continue
+            if query and answer is not None:
+                if not isinstance(answer, bytes):
+                    answer = answer.encode()
+                answers.append(answer)
+
+        if answers:
+            return b';'.join(answers) + b'\n'
+        return None
+
+    def error(self, code, msg):
+        """add an error to the error queue"""
+        self.errors.append('%+i,"%s"' % (code, msg))
+
+    def _idn(self, args, query):
+        return self.idn
+
+    def _rst(self, args, query):
+        self.reset()
+
+    def _cls(self, args, query):
+        self.errors = []
+
+    def _syst_err(self, args, query):
+        if self.errors:
+            return self.errors.pop(0)
+        return '0,"No error"'
+
+    def _sour_func(self, args, query):
+        if query:
+            return self.src_func
+        self.src_func = args.upper()[:4]
+
+    def _sour_param(self, src_type, param):
+        """handler of the source level, mode and sweep parameters"""
+        def handler(args, query):
+            if query:
+                value = self.src_params[src_type][param]
+                if param == 'MODE':
+                    return value
+                return '%+.6E' % value
+            if param == 'MODE':
+                mode = args.upper()
+                for short in ('FIX', 'SWE', 'LIST'):
+                    if mode.startswith(short):
+                        self.src_params[src_type][param] = short
+                        break
+                else:
+                    raise ValueError(args)
+            else:
+                self.src_params[src_type][param] = float(args)
+        return handler
+
+    def _sour_list(self, src_type, append):
+        """handler of the source lists"""
+        def handler(args, query):
+            if query:
+                return ','.join('%+.6E' % val for val in self.src_lists[
+                    src_type])
+            values = [float(val) for val in args.split(',')]
+            if append:
+                values = self.src_lists[src_type] + values
+            if len(values) > MAX_LIST_POINTS:
+                self.error(-223, 'Too much data')
+                return
+            self.src_lists[src_type] = values
+        return handler
+
+    def _sens_prot(self, src_type):
+        """handler of the compliance levels"""
+        def handler(args, query):
+            if query:
+                return '%+.6E' % self.compliance[src_type]
+            self.compliance[src_type] = float(args)
+        return handler
+
+    def _conf(self, meas_type):
+        """handler of the CONF commands"""
+        def handler(args, query):
+            if query:
+                return '"%s:DC"' % self.sense_func
+            self.sense_func = meas_type
+            # :CONF turns the output on
+            self.output = True
+        return handler
+
+    def _sour_cle_auto(self, args, query):
+        if query:
+            return '%i' % self.auto_output_off
+        self.auto_output_off = scpi_on_off(args)
+
+    def _trig_coun(self, args, query):
+        if query:
+            return '%i' % self.trigger_count
+        count = int(float(args))
+        if not 1 <= count <= MAX_TRIGGER_COUNT:
+            raise ValueError(args)
+        self.trigger_count = count
+
+    def _form_elem(self, args, query):
+        if query:
+            return ','.join(self.elements)
+        elements = [elem.strip().upper()[:4] for elem in args.split(',')]
+        for element in elements:
+            if element not in READING_ELEMENTS:
+                raise ValueError(element)
+        # the elements are always returned in the same order
+        self.elements = [elem for elem in READING_ELEMENTS
+                         if elem in elements]
+
+    def _form_data(self, args, query):
+        if query:
+            if self.data_format == 'ASCII':
+                return 'ASC'
+            return self.data_format
+        data_format = args.replace(' ', '').upper()
+        if data_format.startswith('ASC'):
+            self.data_format = 'ASCII'
+        elif data_format in ('REAL,32', 'SREAL'):
+            self.data_format = data_format
+        else:
+            raise ValueError(args)
+
+    def _form_bord(self, args, query):
+        if query:
+            return self.byte_order
+        byte_order = args.upper()[:4]
+        if byte_order not in BYTE_ORDERS:
+            raise ValueError(args)
+        self.byte_order = byte_order
+
+    def _outp(self, args, query):
+        if query:
+            return '%i' % self.output
+        self.output = scpi_on_off(args)
+
+    def _trac_poin(self, args, query):
+        if query:
+            return '%i' % self.trace_points
+        self.trace_points = int(float(args))
+
+    def _trac_poin_act(self, args, query):
+        return '%i' % len(self.trace)
+
+    def _trac_feed_cont(self, args, query):
+        if query:
+            return self.trace_feed
+        self.trace_feed = args.upper()[:4]
+
+    def _trac_cle(self, args, query):
+        self.trace = []
+
+    def _trac_data(self, args, query):
+        return self.format_readings(self.trace)
+
+    def sourced_values(self):
+        """values sourced by the next trigger count points"""
+        params = self.src_params[self.src_func]
+        num_points = self.trigger_count
+
+        if params['MODE'] == 'SWE':
+            if params['STEP'] == 0:
+                values = [params['STAR']]
+            else:
+                values = sweep_setpoints(
+                    params['STAR'],
+                    params['STOP'],
+                    params['STEP']
+                )
+        elif params['MODE'] == 'LIST':
+            values = self.src_lists[self.src_func]
+        else:
+            values = [params['LEV']]
+
+        # the last value is repeated if there are more triggers than values
+        values = list(values)
+        return np.array(
+            (values + [values[-1]] * num_points)[:num_points],
+            dtype=float
+        )
+
+    def _read(self, args, query):
+        """source and measure trigger count points"""
+        if not self.output and not self.auto_output_off:
+            # only auto output off turns the output on for the reading
+            self.error(803, 'Output disabled')
+            return None
+
+        sourced = self.sourced_values()
+
+        if self.src_func == 'VOLT':
+            voltage = sourced
+            current = np.clip(
+                fake_iv_relation('V', sourced),
+                -self.compliance['CURR'],
+                self.compliance['CURR']
+            )
+        else:
+            current = sourced
+            # fake_iv_relation expects the current in uA
+            voltage = fake_iv_relation('I', sourced * 1e6)
+            voltage = np.clip(
+                voltage,
+                -self.compliance['VOLT'],
+                self.compliance['VOLT']
+            )
+
+        now = time.time() - self.start_time
+        readings = []
+        for volt, curr in zip(voltage, current):
+            reading = {
+                'VOLT': volt,
+                'CURR': curr,
+                'RES': volt / curr if curr != 0 else 9.91e37,
+                'TIME': now,
+                'STAT': 0.
+            }
+            readings.append([reading[elem] for elem in self.elements])
+
+        # auto output off turns the output off after the reading
+        if self.auto_output_off:
+            self.output = False
+        if self.trace_feed == 'NEXT':
+            space = self.trace_points - len(self.trace)
+            self.trace.extend(readings[:space])
+
+        return self.format_readings(readings)
+
+    def format_readings(self, readings):
+        """encode readings as they are sent over the bus"""
+        values = [val for reading in readings for val in reading]
+        if self.data_format == 'ASCII':
+            return ','.join('%+.6E' % val for val in values)
+        return BINARY_HEADER + np.array(
+            values,
+            dtype=BYTE_ORDERS[self.byte_order]
+        ).tobytes()
+
+
+class PTYDevice(object):
+    """device answering on the master side of a pseudo terminal, the port
+        to connect to is the slave side
+    """
+
+    def __init__(self, baud_rate=None, latency=0):
+
+        # None doesn't emulate the transfer time of the bytes
+        self.baud_rate = baud_rate
+        # time in seconds the device takes before answering
+        self.latency = latency
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        # statistics of the exchanges
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines_in = 0
+
+        self.running = False
+        self.thread = None
+
+    def __str__(self):
+        return "%s on %s" % (self.__class__.__name__, self.port)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """answer on the pseudo terminal from a background thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=str(self))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """stop answering and close the pseudo terminal"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def reset_stats(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lines_in = 0
+
+    def stats(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'lines_in': self.lines_in
+        }
+
+    def _transfer_time(self, num_bytes):
+        if self.baud_rate:
+            return num_bytes * BITS_PER_BYTE / float(self.baud_rate)
+        return 0
+
+    def _run(self):
+        received = b''
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            self.bytes_in += len(data)
+            # the bytes are only received once transferred
+            time.sleep(self._transfer_time(len(data)))
+            received += data
+            while b'\n' in received:
+                line, received = received.split(b'\n', 1)
+                self.lines_in += 1
+                self.handle_line(line.rstrip(b'\r').decode(errors='replace'))
+
+    def send(self, data):
+        """write data on the pseudo terminal at the emulated baud rate"""
+        time.sleep(self._transfer_time(len(data)))
+        self.bytes_out += len(data)
+        while data:
+            written = os.write(self.master, data)
+            data = data[written:]
+
+    def handle_line(self, line):
+        """should be redefined in children classes"""
+        pass
+
+
+class SerialSimulator(PTYDevice):
+    """instrument connected directly to a serial port"""
+
+    def __init__(self, instrument, **kwargs):
+        super(SerialSimulator, self).__init__(**kwargs)
+        self.instrument = instrument
+
+    def handle_line(self, line):
+        answer = self.instrument.handle(line)
+        if answer is not None:
+            time.sleep(self.latency)
+            self.send(answer)
+
+
+class PrologixSimulator(PTYDevice):
+    """Prologix GPIB-USB controller with instruments indexed per GPIB
+        address, implements the ++ commands used by the drivers
+    """
+
+    def __init__(self, instruments=None, **kwargs):
+        super(PrologixSimulator, self).__init__(**kwargs)
+
+        if instruments is None:
+            instruments = {}
+        self.instruments = instruments
+
+        self.address = 0
+        self.auto = 1
+        self.read_timeout_ms = 500
+        # answer of the instrument waiting to be read and the time at which
+        # it is ready
+        self.pending = None
+        self.pending_time = 0
+
+    def handle_line(self, line):
+        if line.startswith('++'):
+            self.handle_controller_command(line[2:].strip())
+            return
+
+        instrument = self.instruments.get(self.address)
+        if instrument is None:
+            # nobody is listening on the bus
+            return
+
+        answer = instrument.handle(line)
+        if answer is not None:
+            self.pending = answer
+            self.pending_time = time.time() + self.latency
+            if self.auto:
+                self.read_pending()
+        elif self.auto:
+            # the instrument is addressed to talk without anything to say
+            instrument.error(-420, 'Query UNTERMINATED')
+
+    def read_pending(self):
+        """send the answer of the instrument if it is ready within the read
+            timeout, otherwise the controller gives up and the answer stays
+            in the output queue of the instrument
+        """
+        if self.pending is None:
+            return
+        wait = self.pending_time - time.time()
+        if wait > self.read_timeout_ms / 1000.:
+            time.sleep(self.read_timeout_ms / 1000.)
+            return
+        time.sleep(max(0, wait))
+        self.send(self.pending)
+        self.pending = None
+
+    def handle_controller_command(self, line):
+        """execute a ++ command"""
+        parts = line.split()
+        if not parts:
+            return
+        cmd, args = parts[0].lower(), parts[1:]
+
+        if cmd == 'ver':
+            self.send(('%s\r\n' % PROLOGIX_VERSION).encode())
+        elif cmd == 'addr':
+            if args:
+                self.address = int(args[0])
+            else:
+                self.send(('%i\r\n' % self.address).encode())
+        elif cmd == 'auto':
+            if args:
+                self.auto = int(args[0])
+            else:
+                self.send(('%i\r\n' % self.auto).encode())
+        elif cmd == 'read':
+            self.read_pending()
+        elif cmd == 'spoll':
+            address = int(args[0]) if args else self.address
+            if address in self.instruments:
+                status = 0
+                if address == self.address and self.pending is not None \
+                        and time.time() >= self.pending_time:
+                    status |= STB_MAV
+                self.send(('%i\r\n' % status).encode())
+        elif cmd == 'read_tmo_ms':
+            if args:
+                self.read_timeout_ms = int(args[0])
+            else:
+                self.send(('%i\r\n' % self.read_timeout_ms).encode())
+        elif cmd == 'rst':
+            self.address = 0
+            self.auto = 1
+            self.pending = None
+        # ++mode, ++eoi, ++eos, ++eot_enable, ++clr, ++ifc... have no effect
+        # on the simulation
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Simulate a KT2400 behind a Prologix controller'
+    )
+    parser.add_argument('--address', type=int, default=11)
+    parser.add_argument('--baud-rate', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0)
+    options = parser.parse_args()
+
+    simulator = PrologixSimulator(
+        {options.address: KT2400Simulator()},
+        baud_rate=options.baud_rate,
+        latency=options.latency
+    )
+    with simulator:
+        print(
+            "Prologix controller simulated on %s, KT2400 on GPIB0::%i"
+            % (simulator.port, options.address)
+        )
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Archive of IV sweeps which can be reloaded without parsing
+
+An archive is a file of consecutive sweeps, each one made of a header of
+SWEEP_HEADER_SIZE bytes followed by the sourced values and then the measured
+values, as contiguous little-endian float64 arrays.
+
+The header holds a magic string, the format version, the source type, the
+units of the sourced and measured values, the number of points, the
+compliance level and the start and end times of the sweep.
+
+Opening an archive only reads the headers, the values are mapped in memory
+with numpy.memmap and read from the disk when they are used.
+"""
+import os
+import struct
+import time
+
+import numpy as np
+
+SWEEP_MAGIC = b'DDAQSWP\x00'
+SWEEP_VERSION = 1
+# magic, version, source type, source unit, measure unit, number of points,
+# compliance, start time and end time
+SWEEP_HEADER_FORMAT = '<8sI4s8s8sQddd'
+SWEEP_HEADER_SIZE = struct.calcsize(SWEEP_HEADER_FORMAT)
+
+
+class ArchivedSweep(object):
+    """sweep read from an archive, sourced and measured are read-only arrays
+        mapped on the archive
+    """
+
+    def __init__(
+            self,
+            src_type,
+            source_unit,
+            measure_unit,
+            compliance,
+            started,
+            finished,
+            sourced,
+            measured
+    ):
+        self.src_type = src_type
+        self.source_unit = source_unit
+        self.measure_unit = measure_unit
+        self.compliance = compliance
+        self.started = started
+        self.finished = finished
+        self.sourced = sourced
+        self.measured = measured
+
+    def __len__(self):
+        return len(self.sourced)
+
+    def __repr__(self):
+        return "ArchivedSweep(%s, %i points, started %s)" % (
+            self.src_type,
+            len(self),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started))
+        )
+
+
+class SweepArchive(object):
+    """sweeps stored one after the other in a file, new sweeps are appended
+        with add() and the stored ones are accessed by index
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # offset of the header of each sweep in the file
+        self.offsets = []
+        # offset after the last complete sweep
+        self.end = 0
+        # map of the file, None until it is needed
+        self.map = None
+        self._read_headers()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        offset = self.offsets[index]
+        if self.map is None:
+            self.map = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+        header = self._unpack_header(offset)
+        num_points = header['num_points']
+        start = offset + SWEEP_HEADER_SIZE
+        values = self.map[start:start + 16 * num_points].view('<f8')
+
+        return ArchivedSweep(
+            header['src_type'],
+            header['source_unit'],
+            header['measure_unit'],
+            header['compliance'],
+            header['started'],
+            header['finished'],
+            values[:num_points],
+            values[num_points:]
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def _unpack_header(self, offset):
+        """read the header of the sweep at offset in the map of the file"""
+        (
+            magic,
+            version,
+            src_type,
+            source_unit,
+            measure_unit,
+            num_points,
+            compliance,
+            started,
+            finished
+        ) = struct.unpack_from(SWEEP_HEADER_FORMAT, self.map, offset)
+
+        if magic != SWEEP_MAGIC:
+            raise IOError("%s is not a sweep archive" % self.path)
+        if version != SWEEP_VERSION:
+            raise IOError(
+                "%s has the version %i of the archive format, not %i"
+                % (self.path, version, SWEEP_VERSION)
+            )
+
+        return {
+            'src_type': src_type.rstrip(b'\x00').decode(),
+            'source_unit': source_unit.rstrip(b'\x00').decode(),
+            'measure_unit': measure_unit.rstrip(b'\x00').decode(),
+            'num_points': num_points,
+            'compliance': compliance,
+            'started': started,
+            'finished': finished
+        }
+
+    def _read_headers(self):
+        """find the offsets of the sweeps, a sweep cut by a crash while it
+            was written is ignored
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+
+        self.map = np.memmap(self.path, dtype=np.uint8, mode='r')
+        size = len(self.map)
+        offset = 0
+        while offset + SWEEP_HEADER_SIZE <= size:
+            header = self._unpack_header(offset)
+            end = offset + SWEEP_HEADER_SIZE + 16 * header['num_points']
+            if end > size:
+                break
+            self.offsets.append(offset)
+            offset = end
+        # the next sweep is written after the last complete one
+        self.end = offset
+
+    def add(
+            self,
+            sourced,
+            measured,
+            src_type='V',
+            source_unit='V',
+            measure_unit='A',
+            compliance=np.nan,
+            started=None,
+            finished=None
+    ):
+        """append a sweep to the archive, returns its index"""
+        sourced = np.asarray(sourced, dtype='<f8').ravel()
+        measured = np.asarray(measured, dtype='<f8').ravel()
+        if len(sourced) != len(measured):
+            raise ValueError(
+                "There are %i sourced values and %i measured values"
+                % (len(sourced), len(measured))
+            )
+
+        if finished is None:
+            finished = time.time()
+        if started is None:
+            started = finished
+
+        header = struct.pack(
+            SWEEP_HEADER_FORMAT,
+            SWEEP_MAGIC,
+            SWEEP_VERSION,
+            src_type.encode(),
+            source_unit.encode(),
+            measure_unit.encode(),
+            len(sourced),
+            compliance,
+            started,
+            finished
+        )
+
+        with open(self.path, 'ab') as f:
+            if os.path.getsize(self.path) != self.end:
+                # drop a sweep which wasn't completely written
+                f.truncate(self.end)
+            f.write(header + sourced.tobytes() + measured.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.offsets.append(self.end)
+        self.end += SWEEP_HEADER_SIZE + 16 * len(sourced)
+        # the map doesn't cover the new sweep
+        self.map = None
+        return len(self.offsets) - 1